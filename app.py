@@ -1,24 +1,80 @@
-from flask import Flask, render_template
-from pymongo import MongoClient
+from flask import Flask, Response, abort, render_template, request, stream_with_context
 from os import environ
+from collections import OrderedDict
+from threading import Lock
+from strategy.database import db
+from strategy.dashboard import dashboard_rows, latest_forms
+from strategy.holdings import holders, added_by
+import hashlib
+import time
 
 app = Flask(__name__)
-client = MongoClient(environ['MONGODB_URI'])
-db = client.get_database()
-num_stock_list = [5, 15, 50]
+DASHBOARD_TTL = int(environ.get('DASHBOARD_TTL', 60))    # Seconds before the home page rereads the snapshot
+dashboard_cache = {'rows': None, 'expires': 0}
+COMPANY_CHECK_INTERVAL = int(environ.get('COMPANY_CHECK_INTERVAL', 10))     # Seconds between version checks
+company_cache = {'companies': None, 'version': None, 'checked': 0}
+FORM_LIST_FIELDS = {'_id': 0, 'cik': 1, 'sec_id': 1, 'name': 1, 'date': 1, 'total_val': 1, 'gain': 1,
+                    'num_holdings': 1}
+OPTIONS_STAGES = [{'$match': {'$expr': {'$gt': ['$total_val', '$share_val']}}},
+                  {'$project': {'total_val': 1, 'share_val': 1, 'num_holdings': 1,
+                                'share_num': {'$size': {'$filter': {'input': '$holdings_security_type', 'as': 'type',
+                                                                    'cond': {'$eq': ['$$type', 'Share']}}}}}}]
+
+FORM_CACHE_PAGES = int(environ.get('FORM_CACHE_PAGES', 64))    # Rendered filing pages kept per process
+FORM_PAGE_SIZE = int(environ.get('FORM_PAGE_SIZE', 500))
+FORM_STREAM_BUFFER = 100    # Template chunks per write while streaming
+HOLDING_SORTS = {'ticker', 'name', 'security_type', 'value', 'units'}
+
+
+class PageCache:
+    def __init__(self, max_pages):
+        self.max_pages = max_pages
+        self.pages = OrderedDict()      # Least recently used first, each an (etag, html) pair
+        self.lock = Lock()
+
+    def get(self, key, etag):
+        with self.lock:
+            if key in self.pages and self.pages[key][0] == etag:
+                self.pages.move_to_end(key)
+                return self.pages[key][1]
+        return None
+
+    def put(self, key, etag, html):
+        with self.lock:
+            self.pages[key] = (etag, html)
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+
+form_pages = PageCache(FORM_CACHE_PAGES)
+
+
+def company_list():     # Sorted sidebar list, reread only after edgar bumps the companies version
+    now = time.monotonic()
+    if company_cache['companies'] is None or now > company_cache['checked'] + COMPANY_CHECK_INTERVAL:
+        stored = db.versions.find_one({'name': 'companies'}, {'version': 1}) or {}
+        if company_cache['companies'] is None or stored.get('version') != company_cache['version']:
+            company_cache['companies'] = sorted(db.companies.find({}, {'_id': 0, 'cik': 1, 'name': 1}),
+                                                key=lambda x: x['name'])
+            company_cache['version'] = stored.get('version')
+        company_cache['checked'] = now
+    return company_cache['companies']
+
+
+def cached_dashboard():
+    if dashboard_cache['rows'] is None or time.monotonic() > dashboard_cache['expires']:
+        dashboard_cache['rows'] = dashboard_rows()
+        dashboard_cache['expires'] = time.monotonic() + DASHBOARD_TTL
+    return dashboard_cache['rows']
 
 
 @app.route('/')
 def home():
-    companies = db.companies.find()
     data = []
-    for item in companies:
-        form = db.forms.find_one({'$query': {'cik': item['cik']}, '$orderby': {'date': -1}})
-        form['backtest'] = db.backtest.find_one({'cik': item['cik']})
-        if form['backtest'].get(str(max(num_stock_list))) is not None:
-            form['return'] = format(form['backtest'][str(max(num_stock_list))]['return'], '.2f')
-        else:
-            form['return'] = 'N/A'
+    for row in cached_dashboard():
+        form = dict(row)
+        form['return'] = format(form['return'], '.2f') if form.get('return') is not None else 'N/A'
         form['num_holdings'] = "{:,}".format(form['num_holdings'])
         form['total_val'] = "{:,}".format(form['total_val'])
         if form['gain'] > 0:
@@ -27,19 +83,19 @@ def home():
             form['gain_class'] = "red-loss"
         form['gain'] = "{:,}".format(form['gain'])
         data.append(form)
-    return render_template('index.html', data=data, companies=sorted(db.companies.find(), key=lambda x: x['name']))
+    return render_template('index.html', data=data, companies=company_list())
 
 
 @app.route('/faq')
 def faq():
-    companies = sorted(db.companies.find(), key=lambda x: x['name'])
+    companies = company_list()
     return render_template('faq.html', companies=companies)
 
 
 @app.route('/company/<cik>')
 def company(cik):
-    companies = sorted(db.companies.find(), key=lambda x: x['name'])
-    forms = db.forms.find({'cik': cik})
+    companies = company_list()
+    forms = db.forms.find({'cik': cik}, FORM_LIST_FIELDS)
     data = []
     for form in forms:
         form['num_holdings'] = "{:,}".format(form['num_holdings'])
@@ -53,30 +109,97 @@ def company(cik):
     return render_template('company.html', data=data, companies=companies)
 
 
-@app.route('/company/<cik>/<sec_id>')
-def form_page(cik, sec_id):
-    companies = sorted(db.companies.find(), key=lambda x: x['name'])
-    data = db.forms.find_one({'cik': cik, 'sec_id': sec_id})
-    for holding in data['holdings']:
+def form_etag(cik, sec_id, view):     # Filings never change, but the page also carries the sidebar
+    version = str(company_cache['version'])
+    return hashlib.sha1('/'.join([cik, sec_id, version] + [str(part) for part in view]).encode()).hexdigest()
+
+
+def holdings_page(cik, sec_id, page, sort, descending):
+    pipeline = [{'$match': {'cik': cik, 'sec_id': sec_id}},
+                {'$unwind': {'path': '$holdings', 'includeArrayIndex': 'index'}},
+                {'$sort': {'holdings.' + sort: -1 if descending else 1, 'index': 1}},    # Ties keep filing order
+                {'$skip': (page - 1) * FORM_PAGE_SIZE},
+                {'$limit': FORM_PAGE_SIZE},
+                {'$replaceRoot': {'newRoot': '$holdings'}}]
+    for holding in db.forms.aggregate(pipeline):
         holding['value'] = "{:,}".format(holding['value'])
         holding['units'] = "{:,}".format(holding['units'])
-    return render_template('form.html', data=data, companies=companies)
+        yield holding
+
+
+def stream_page(template_name, cache_key, etag, **context):     # Caches the page once it has been sent in full
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(FORM_STREAM_BUFFER)
+
+    def generate():
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        form_pages.put(cache_key, etag, ''.join(chunks))
+    return Response(stream_with_context(generate()))
+
+
+@app.route('/company/<cik>/<sec_id>')
+def form_page(cik, sec_id):
+    companies = company_list()
+    sort = request.args.get('sort', 'value')
+    if sort not in HOLDING_SORTS:
+        abort(400)
+    descending = request.args.get('order', 'desc') != 'asc'
+    page = request.args.get('page', 1, type=int)
+    view = (page, sort, descending)
+    etag = form_etag(cik, sec_id, view)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    html = form_pages.get((sec_id,) + view, etag)
+    if html is not None:
+        response = Response(html)
+    else:
+        data = db.forms.find_one({'cik': cik, 'sec_id': sec_id},
+                                 {'_id': 0, 'cik': 1, 'sec_id': 1, 'name': 1, 'date': 1, 'num_holdings': 1})
+        pages = max(1, -(-data['num_holdings'] // FORM_PAGE_SIZE)) if data is not None else 0
+        if not 1 <= page <= pages:
+            abort(404)
+        data['holdings'] = holdings_page(cik, sec_id, page, sort, descending)
+        response = stream_page('form.html', (sec_id,) + view, etag, data=data, companies=companies,
+                               page=page, pages=pages, sort=sort, order='desc' if descending else 'asc')
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/options')
 def options():
-    companies = sorted(db.companies.find(), key=lambda x: x['name'])
+    companies = company_list()
+    latest = {form['_id']: form for form in
+              latest_forms([item['cik'] for item in companies], ['total_val', 'share_val', 'num_holdings',
+                                                                 'holdings.security_type'], OPTIONS_STAGES)}
     data = {}
     for item in companies:
-        form = db.forms.find_one({'$query': {'cik': item['cik']}, '$orderby': {'date': -1}})
-        options_val = form['total_val'] - form['share_val']
-        if options_val > 0:
+        form = latest.get(item['cik'])
+        if form is not None:
+            options_val = form['total_val'] - form['share_val']
             data[item['cik']] = {'cik': item['cik'], 'name': item['name'], 'options_val': "{:,}".format(options_val)}
-            data[item['cik']]['options_pc'] = round(((form['total_val'] - form['share_val']) / form['total_val'])*100, 1)
-            share_num = len([holding for holding in form['holdings'] if holding['security_type'] == 'Share'])
-            data[item['cik']]['options_num'] = form['num_holdings'] - share_num
+            data[item['cik']]['options_pc'] = round((options_val / form['total_val'])*100, 1)
+            data[item['cik']]['options_num'] = form['num_holdings'] - form['share_num']
     return render_template('options.html', data=data, companies=companies)
 
 
+@app.route('/ticker/<ticker>')
+def ticker_page(ticker):
+    companies = company_list()
+    names = {company['cik']: company['name'] for company in companies}
+    since = request.args.get('since')
+    data = added_by(ticker, since) if since else holders(ticker)
+    for holding in data:
+        holding['company'] = names.get(holding['cik'], holding['cik'])
+        holding['value'] = "{:,}".format(holding['value'])
+        holding['units'] = "{:,}".format(holding['units'])
+    return render_template('ticker.html', data=data, ticker=ticker, since=since, companies=companies)
+
+
 if __name__ == '__main__':
     app.run()
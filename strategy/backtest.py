@@ -1,9 +1,12 @@
-from os import environ
-from pymongo import MongoClient
-from strategy.stockdata import get_data, specific_open, recent_open, next_trading_day, DataError
+import time
+import hashlib
+from pymongo import UpdateOne
+from strategy import pricestore
+from strategy.database import db
+from strategy.stockdata import open_as_of, next_trading_day, DataError, PriceBook
 
-client = MongoClient(environ['MONGODB_URI'])
 MIN_13F_DATE = '2014-01-01'
+PRELOAD_DEPTH = 2   # Preload prices for this many times num_stocks of each form's largest holdings
 
 
 def value_to_weight(holdings):
@@ -12,7 +15,6 @@ def value_to_weight(holdings):
 
 
 def db_get_forms(cik, min_date, max_date):
-    db = client.get_database()
     forms = db.forms.find({'cik': cik})
     form_dates = {}
     for form13f in forms:
@@ -22,60 +24,80 @@ def db_get_forms(cik, min_date, max_date):
     return form_dates
 
 
+def share_holdings(form13f):
+    return {holding['ticker']: holding['value'] for holding in form13f['holdings']
+            if holding['security_type'] == 'Share'}     # Ignoring put and call options to keep it simple
+
+
 def db_get_form_holdings(form_name, cik):
-    db = client.form13f
     form13f = db.forms.find_one({'$and': [{'cik': cik}, {'sec_id': form_name}]})
-    share_holdings = {holding['ticker']: holding['value'] for holding in form13f['holdings']
-                      if holding['security_type'] == 'Share'}
-    return share_holdings  # Ignoring put and call options to keep it simple
+    return share_holdings(form13f)
 
 
-def find_valid_tickers(all_holdings, num_stocks, failed, form_date):
-    largest_tickers = sorted(all_holdings, key=all_holdings.get, reverse=True)[:num_stocks]
-    largest_holdings = {ticker: all_holdings[ticker] for ticker in largest_tickers}
-    tickers = [ticker for ticker in largest_holdings.keys() if ticker not in failed]
-    failed.extend(get_data(tickers, form_date))
-    successful = {ticker: value for ticker, value in largest_holdings.items() if ticker not in failed}
-    weights = value_to_weight(successful)
-    return weights, failed
+def db_get_all_form_holdings(cik, form_names):
+    forms = db.forms.find({'cik': cik, 'sec_id': {'$in': list(form_names)}}, {'sec_id': 1, 'holdings': 1})
+    return {form13f['sec_id']: share_holdings(form13f) for form13f in forms}
 
 
-def ensure_valid_data(form_name, form_date, next_date, cik, num_stocks):
-    weights = {}
-    failed = []
-    all_holdings = db_get_form_holdings(form_name, cik)
-    while len(weights) < num_stocks:
-        num_stocks_new = num_stocks + len(failed)
-        weights, failed = find_valid_tickers(all_holdings, num_stocks_new, failed, form_date)
-        print("BACKTEST: " + str(len(weights)) + " valid weights from " + str(num_stocks_new) + " tickers")
-        if len(all_holdings) < num_stocks:
-            print("WARNING/BT: This filing has " + str(len(all_holdings)) +
-                  " stocks, but asked for " + str(num_stocks_new) + ". Using all available.")
-            weights, failed = find_valid_tickers(all_holdings, len(all_holdings), failed, form_date)
-            break
-        if len(all_holdings) - len(failed) <= num_stocks:
-            print("WARNING/BT:Data retrieval failed for too many (" + str(len(failed)) +
-                  ") tickers. Using all available")
-            weights, failed = find_valid_tickers(all_holdings, len(all_holdings), failed, form_date)
-            break
+class FormHoldings:
+    def __init__(self, all_holdings):
+        self.holdings = all_holdings
+        self.ranked = sorted(all_holdings, key=all_holdings.get, reverse=True)   # Sorted once, shared by every size
+
+    def __len__(self):
+        return len(self.ranked)
+
+    def top(self, num_stocks, form_date, book):
+        chosen = []
+        position = 0
+        while len(chosen) < num_stocks and position < len(self.ranked):
+            batch = self.ranked[position:position + num_stocks - len(chosen)]
+            position += len(batch)
+            failed = book.get_data(batch, form_date)
+            chosen.extend(ticker for ticker in batch if ticker not in failed)
+        return {ticker: self.holdings[ticker] for ticker in chosen}
+
+
+def preload_prices(forms, num_stocks):
+    tickers = set()
+    for form in forms.values():
+        tickers.update(form.ranked[:num_stocks * PRELOAD_DEPTH])
+    print("BACKTEST: Preloading prices for " + str(len(tickers)) + " tickers")
+    return PriceBook(tickers)
+
+
+def select_weights(form, form_date, next_date, num_stocks, book):
+    largest = form.top(num_stocks, form_date, book)
+    print("BACKTEST: " + str(len(largest)) + " valid weights from " + str(len(form)) + " holdings")
+    if len(form) < num_stocks:
+        print("WARNING/BT: This filing has " + str(len(form)) +
+              " stocks, but asked for " + str(num_stocks) + ". Using all available.")
+    elif len(largest) < num_stocks:
+        print("WARNING/BT:Data retrieval failed for too many (" + str(len(form) - len(largest)) +
+              ") tickers. Using all available")
+    weights = value_to_weight(largest) if largest else {}
     if next_date is not None:
-        get_data(list(weights.keys()), next_date)  # Failed future data is ignored to avoid lookahead bias
+        book.get_data(list(weights.keys()), next_date)  # Failed future data is ignored to avoid lookahead bias
     return weights
 
 
-def get_values(portfolio, next_weight, date):
+def ensure_valid_data(form_name, form_date, next_date, cik, num_stocks):
+    return select_weights(FormHoldings(db_get_form_holdings(form_name, cik)), form_date, next_date, num_stocks,
+                          PriceBook())
+
+
+def get_values(portfolio, next_weight, date, book=None):
     tickers = list(portfolio.keys())
     next_tickers = [ticker for ticker in next_weight.keys()]
     tickers.extend(next_tickers)
     tickers.remove('cash')
     portfolio_value = {'cash': portfolio['cash']}
     prices = {'cash': 1}
+    lookup = open_as_of if book is None else book.open_as_of
     for ticker in tickers:
-        open_price = specific_open(ticker, date)
-        if open_price is None and ticker in next_tickers:  # Required for all next tickers (buying) but not current
+        price_date, open_price = lookup(ticker, date)    # Falls back to the most recent earlier open
+        if price_date != date and ticker in next_tickers:  # Required for all next tickers (buying) but not current
             raise DataError("Cannot backtest further (unknown buy price for '" + ticker + "').")
-        elif open_price is None:
-            open_price = recent_open(ticker, date)
 
         if open_price is None:  # Need at least a price from some time in the past for current tickers
             raise DataError("Cannot backtest further (unknown sale price for '" + ticker + "').")
@@ -111,33 +133,154 @@ def buy_sell(portfolio, str_prices, delta, total):
     return {ticker: shares for ticker, shares in portfolio.items() if shares != 0}
 
 
-def rebalance(portfolio, next_weight, date):
-    portfolio_value, prices = get_values(portfolio, next_weight, date)
+def rebalance(portfolio, next_weight, date, book=None):
+    portfolio_value, prices = get_values(portfolio, next_weight, date, book)
     total = sum(portfolio_value.values())
     print("BACKTEST: Portfolio value: $" + str(round(total, 2)) + " on " + date)
     delta = compare_weights(value_to_weight(portfolio_value), next_weight)
     return buy_sell(portfolio, prices, delta, total), total
 
 
-def backtest(cik, min_date, max_date, num_stocks, initial_bank):
+def prepare_backtest(cik, min_date, max_date):
     if min_date < MIN_13F_DATE:
         print("WARNING/BT: Minimum date " + min_date + " less than global minimum. Using " + MIN_13F_DATE + " instead.")
         min_date = MIN_13F_DATE
     form_dates = db_get_forms(cik, min_date, max_date)
 
     trading_dates = {sec_id: next_trading_day(date) for sec_id, date in form_dates.items()}
-    portfolio = {"cash": initial_bank}
     to_backtest = list(sorted(trading_dates.items(), key=lambda item: item[1]))
+    schedule = []
     next_date_index = 0
-    running_balance = 0
-
     for formID, date in to_backtest:
         next_date_index += 1
         next_date = to_backtest[next_date_index][1] if len(to_backtest) > next_date_index else None
-        weights = ensure_valid_data(formID, date, trading_dates.get(next_date), cik, num_stocks)
-        portfolio, running_balance = rebalance(portfolio, weights, trading_dates[formID])
-        print("BACKTEST: " + str(portfolio))
+        schedule.append((formID, date, trading_dates.get(next_date)))
+    return min_date, schedule
+
+
+def load_backtest_data(cik, schedule, num_stocks):
+    forms = {formID: FormHoldings(all_holdings)
+             for formID, all_holdings in db_get_all_form_holdings(cik, [formID for formID, _, _ in schedule]).items()}
+    return forms, preload_prices(forms, num_stocks)
+
+
+def checkpoint_versions(schedule, min_date, initial_bank):   # One version per form, covering every form before it
+    digest = hashlib.sha1((min_date + "|" + str(initial_bank)).encode())
+    versions = []
+    for formID, date, _ in schedule:
+        digest.update(("|" + formID + "|" + date).encode())
+        versions.append(digest.hexdigest())
+    return versions
+
+
+def db_get_checkpoints(cik, num_stocks_list, versions):
+    checkpoints = db.backtest_checkpoints.find({'cik': cik, 'num_stocks': {'$in': list(num_stocks_list)},
+                                                'data_version': {'$in': versions}})
+    latest = {}
+    for checkpoint in sorted(checkpoints, key=lambda item: versions.index(item['data_version'])):
+        latest.setdefault(checkpoint['num_stocks'], []).insert(0, checkpoint)   # Latest first
+    revisions = pricestore.revisions({ticker for found in latest.values() for checkpoint in found
+                                      for ticker, _ in checkpoint['prices']})
+    valid = {}
+    for num_stocks, found in latest.items():
+        for checkpoint in found:    # Adjusted prices used before the checkpoint must not have been rewritten since
+            if all(revisions.get(ticker) == revision for ticker, revision in checkpoint['prices']):
+                valid[num_stocks] = checkpoint
+                break
+    return valid
+
+
+def checkpoint_update(cik, num_stocks, version, run, date, formID, portfolio, running_balance, revisions):
+    return UpdateOne({'cik': cik, 'num_stocks': num_stocks, 'data_version': version},
+                     {'$set': {'run': run, 'date': date, 'sec_id': formID, 'running_balance': running_balance,
+                               'portfolio': [[ticker, shares] for ticker, shares in portfolio.items()],
+                               'prices': [[ticker, revision] for ticker, revision in revisions.items()]}},
+                     upsert=True)
+
+
+def db_save_checkpoints(updates):
+    if updates:
+        db.backtest_checkpoints.bulk_write(updates, ordered=False)
+
+
+def db_drop_stale_checkpoints(cik, num_stocks_list, run, versions):
+    db.backtest_checkpoints.delete_many({'cik': cik, 'num_stocks': {'$in': list(num_stocks_list)}, 'run': run,
+                                         'data_version': {'$nin': versions}})
+
+
+def backtest_many(cik, min_date, max_date, num_stocks_list, initial_bank, resume=False, restart=True):
+    min_date, schedule = prepare_backtest(cik, min_date, max_date)
+    portfolios = {num_stocks: {"cash": initial_bank} for num_stocks in num_stocks_list}
+    running_balances = {num_stocks: 0 for num_stocks in num_stocks_list}
+    revisions = {num_stocks: {} for num_stocks in num_stocks_list}
+    start = {num_stocks: 0 for num_stocks in num_stocks_list}
+    versions = checkpoint_versions(schedule, min_date, initial_bank)
+    run = min_date + "|" + str(initial_bank)    # Runs with other settings keep their own checkpoints
+    if resume:
+        for num_stocks, checkpoint in db_get_checkpoints(cik, num_stocks_list, versions).items():
+            start[num_stocks] = versions.index(checkpoint['data_version']) + 1
+            portfolios[num_stocks] = dict(checkpoint['portfolio'])
+            running_balances[num_stocks] = checkpoint['running_balance']
+            revisions[num_stocks] = dict(checkpoint['prices'])
+            print("BACKTEST: Resuming " + cik + " with " + str(num_stocks) + " stocks after " + checkpoint['date'])
+    forms, book = load_backtest_data(cik, schedule[min(start.values()):], max(num_stocks_list))
+
+    stale = set()   # Sizes whose earlier state used prices that have since been adjusted
+    failed = set()
+    for index, (formID, date, next_date) in enumerate(schedule):
+        checkpoints = []
+        for num_stocks in num_stocks_list:
+            if index < start[num_stocks] or num_stocks in stale or num_stocks in failed:
+                continue
+            try:
+                weights = select_weights(forms[formID], date, next_date, num_stocks, book)
+            except DataError as e:
+                print("WARNING/BT: Backtest for " + cik + " with " + str(num_stocks) + " stocks stopped: " + str(e))
+                failed.add(num_stocks)
+                continue
+            current = {ticker: book.revision(ticker) for ticker in list(portfolios[num_stocks]) + list(weights)
+                       if ticker != 'cash'}
+            if restart and any(revisions[num_stocks].get(ticker, revision) != revision
+                               for ticker, revision in current.items()):
+                print("WARNING/BT: Prices for " + cik + " were adjusted mid-run. Restarting " + str(num_stocks) +
+                      " stocks.")
+                stale.add(num_stocks)
+                continue
+            revisions[num_stocks].update(current)
+            try:
+                portfolios[num_stocks], running_balances[num_stocks] = rebalance(portfolios[num_stocks], weights,
+                                                                                 date, book)
+            except DataError as e:
+                print("WARNING/BT: Backtest for " + cik + " with " + str(num_stocks) + " stocks stopped: " + str(e))
+                failed.add(num_stocks)
+                continue
+            print("BACKTEST: " + str(portfolios[num_stocks]))
+            if resume:
+                checkpoints.append(checkpoint_update(cik, num_stocks, versions[index], run, date, formID,
+                                                     portfolios[num_stocks], running_balances[num_stocks],
+                                                     revisions[num_stocks]))
+        db_save_checkpoints(checkpoints)
+    if resume:
+        db_drop_stale_checkpoints(cik, num_stocks_list, run, versions)
+
+    results = {str(num_stocks): {'num_stocks': str(len(portfolios[num_stocks]) - 1),
+                                 'min_date': min_date,
+                                 'return': round(((running_balances[num_stocks] / initial_bank) - 1) * 100, 2)}
+               for num_stocks in num_stocks_list if num_stocks not in stale and num_stocks not in failed}
+    if stale:   # Checkpoints from the old prices no longer validate, so this starts over on the new ones
+        results.update(backtest_many(cik, min_date, max_date, sorted(stale), initial_bank, resume, restart=False))
+    return results
+
+
+def backtest(cik, min_date, max_date, num_stocks, initial_bank):
+    return str(num_stocks), backtest_many(cik, min_date, max_date, [num_stocks], initial_bank)[str(num_stocks)]
+
 
-    return str(num_stocks), {'num_stocks': str(len(portfolio) - 1),
-                             'min_date': min_date,
-                             'return': round(((running_balance / initial_bank) - 1) * 100, 2)}
+def backtest_job(engine, cik, min_date, max_date, num_stocks_list, initial_bank):
+    start = time.perf_counter()
+    try:
+        results = engine(cik, min_date, max_date, num_stocks_list, initial_bank)
+    except DataError as e:
+        print("WARNING/BT: Backtest for " + cik + " stopped: " + str(e))
+        results = {}
+    return cik, results, time.perf_counter() - start
@@ -1,9 +1,11 @@
 import os
+import hashlib
 
-from pymongo import MongoClient
+from pymongo import UpdateOne
+from strategy.database import db
+from strategy.indexes import ensure_indexes
 
-client = MongoClient(os.environ['MONGODB_URI'])
-db = client.get_database()
+UPSERT_BATCH = 10000
 
 
 def create_cusip_map(directory):
@@ -17,17 +19,86 @@ def create_cusip_map(directory):
     return cusip_map
 
 
-def parse_fail_filing(file):
-    file_map = {}
+def iter_fail_filing(file):     # (cusip, ticker, settlement date) for each row, skipping the header
     for line in file:
         col = line.split('|')
-        if len(col) > 2:
-            file_map[col[1]] = col[2].replace("XXXX", "").replace("ZZZZ", "")  # SEC sometimes pads with extra letters
-    del file_map['CUSIP']
-    return file_map
+        if len(col) > 2 and col[1] != 'CUSIP':
+            date = col[0][:4] + '-' + col[0][4:6] + '-' + col[0][6:] if len(col[0]) == 8 else col[0]
+            ticker = col[2].replace("XXXX", "").replace("ZZZZ", "")  # SEC sometimes pads with extra letters
+            yield col[1], ticker, date
+
+
+def parse_fail_filing(file):
+    return {cusip: ticker for cusip, ticker, _ in iter_fail_filing(file)}
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def changed_files(directory):   # Fails files that are new, or whose contents changed since they were ingested
+    seen = {file['name']: file for file in db.cusipfiles.find()}
+    changed = []
+    for filename in sorted(os.listdir(directory)):      # SEC names sort by period, so later tickers win
+        if not filename.endswith(".txt"):
+            continue
+        path = os.path.join(directory, filename)
+        stat = os.stat(path)
+        file = {'name': filename, 'mtime': stat.st_mtime, 'size': stat.st_size}
+        previous = seen.get(filename)
+        if previous is not None and previous['mtime'] == file['mtime'] and previous['size'] == file['size']:
+            continue
+        file['sha1'] = file_digest(path)
+        if previous is not None and previous.get('sha1') == file['sha1']:   # Touched but unchanged
+            db.cusipfiles.update_one({'name': filename}, {'$set': file})
+            continue
+        changed.append((path, file))
+    return changed
+
+
+def ingest_update(ticker, first, last):     # A re-ingested older file must not replace a newer ticker
+    return [{'$set': {'ticker': {'$cond': [{'$gte': [last, {'$ifNull': ['$last_seen', '']}]}, ticker, '$ticker']},
+                      'first_seen': {'$min': ['$first_seen', first]},
+                      'last_seen': {'$max': ['$last_seen', last]}}}]
+
+
+def ingest_fail_filing(path):
+    seen = {}
+    with open(path, encoding="ASCII", errors="ignore") as f:
+        for cusip, ticker, date in iter_fail_filing(f):
+            first, last = seen[cusip][1:] if cusip in seen else (date, date)
+            seen[cusip] = (ticker, min(first, date), max(last, date))
+    writes = [UpdateOne({'cusip': cusip}, ingest_update(ticker, first, last), upsert=True)
+              for cusip, (ticker, first, last) in seen.items()]
+    for i in range(0, len(writes), UPSERT_BATCH):
+        db.cusips.bulk_write(writes[i:i + UPSERT_BATCH], ordered=False)
+    return len(writes)
+
+
+def migrate_legacy_map():   # Moves the old single-document map into the collection
+    legacy = db.cusipmap.find_one()
+    if legacy is None or db.cusips.find_one() is not None:
+        return 0
+    writes = [UpdateOne({'cusip': cusip}, {'$setOnInsert': {'ticker': ticker}}, upsert=True)
+              for cusip, ticker in legacy.items() if cusip not in ('_id', 'version')]
+    for i in range(0, len(writes), UPSERT_BATCH):
+        db.cusips.bulk_write(writes[i:i + UPSERT_BATCH], ordered=False)
+    db.versions.update_one({'name': 'cusips'}, {'$inc': {'version': 1}}, upsert=True)
+    print("CUSIP: Migrated " + str(len(writes)) + " mappings from the legacy map")
+    return len(writes)
 
 
 def update_cusip():
-    cusip_map = db.cusipmap.find_one()
-    cusip_map.update(create_cusip_map(os.environ["CUSIP_DIR"]))
-    db.cusipmap.replace_one({}, cusip_map, upsert=True)
+    ensure_indexes(['cusips', 'cusipfiles'])
+    updated = migrate_legacy_map()
+    for path, file in changed_files(os.environ["CUSIP_DIR"]):
+        updated += ingest_fail_filing(path)
+        db.cusipfiles.replace_one({'name': file['name']}, file, upsert=True)
+        print("CUSIP: Ingested " + file['name'])
+    if updated:     # Lets edgar.CusipResolver notice the new map without reloading it
+        db.versions.update_one({'name': 'cusips'}, {'$inc': {'version': 1}}, upsert=True)
+    return updated
@@ -0,0 +1,44 @@
+from pymongo import ReplaceOne
+from strategy.database import db
+
+BACKTEST_KEY = '50'     # Home page shows the top 50 backtest
+SUMMARY_FIELDS = ['sec_id', 'date', 'total_val', 'gain', 'num_holdings']
+
+
+def latest_forms(ciks, fields, stages=()):     # One pass over date-sorted forms keeping each CIK's newest
+    pipeline = [{'$match': {'cik': {'$in': list(ciks)}, 'date': {'$exists': True}}},
+                {'$sort': {'cik': 1, 'date': -1}},
+                {'$group': dict({'_id': '$cik'},    # Dotted paths come back with underscores
+                                **{field.replace('.', '_'): {'$first': '$' + field} for field in fields})}]
+    return db.forms.aggregate(pipeline + list(stages), allowDiskUse=True)
+
+
+def rebuild_dashboard(ciks=None):
+    query = {'cik': {'$in': list(ciks)}} if ciks is not None else {}
+    names = {company['cik']: company['name'] for company in db.companies.find(query, {'cik': 1, 'name': 1})}
+    stored = db.backtest.find({'cik': {'$in': list(names)}}, {'cik': 1, BACKTEST_KEY + '.return': 1})
+    backtests = {backtest['cik']: backtest.get(BACKTEST_KEY, {}).get('return') for backtest in stored}
+    writes = []
+    rows = []
+    for form in latest_forms(names, SUMMARY_FIELDS):
+        row = {field: form.get(field) for field in SUMMARY_FIELDS}
+        row['cik'] = form['_id']
+        row['name'] = names[row['cik']]
+        row['return'] = backtests.get(row['cik'])
+        rows.append(row)
+        writes.append(ReplaceOne({'cik': row['cik']}, row, upsert=True))
+    if writes:
+        db.dashboard.bulk_write(writes, ordered=False)
+    if ciks is None:
+        db.dashboard.delete_many({'cik': {'$nin': [row['cik'] for row in rows]}})
+    print("DASHBOARD: Rebuilt " + str(len(rows)) + " summaries")
+    return rows
+
+
+def dashboard_rows():
+    rows = list(db.dashboard.find({}, {'_id': 0}))
+    if not rows:    # Worker has not built the snapshot yet
+        rows = rebuild_dashboard()
+        for row in rows:
+            row.pop('_id', None)
+    return rows
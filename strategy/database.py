@@ -0,0 +1,42 @@
+from os import environ, getpid
+from threading import Lock
+import pymongo
+
+POOL_SIZE = int(environ.get('MONGODB_POOL_SIZE', 20))   # Connections per process
+state = {'client': None, 'pid': None, 'backend': None}
+lock = Lock()
+
+
+def default_backend(pool_size):
+    return pymongo.MongoClient(environ['MONGODB_URI'], maxPoolSize=pool_size, connect=False)
+
+
+def use_backend(backend):   # Called with the pool size, e.g. to hand tests an in-memory stand-in
+    with lock:
+        state['backend'] = backend
+        state['client'] = None
+
+
+def get_client():   # Connects on first use, and again in a forked child since pymongo clients are not fork-safe
+    if state['client'] is None or state['pid'] != getpid():
+        with lock:
+            if state['client'] is None or state['pid'] != getpid():
+                backend = state['backend'] or default_backend
+                state['client'] = backend(POOL_SIZE)
+                state['pid'] = getpid()
+    return state['client']
+
+
+def get_database():
+    return get_client().get_database()
+
+
+class LazyDatabase:     # Stands in for a pymongo Database so modules can keep a module-level db
+    def __getattr__(self, name):
+        return getattr(get_database(), name)
+
+    def __getitem__(self, name):
+        return get_database()[name]
+
+
+db = LazyDatabase()
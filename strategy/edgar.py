@@ -1,12 +1,15 @@
 from enum import Enum
-import requests
-from os import environ
+from threading import Lock
 from bs4 import BeautifulSoup
-from pymongo import MongoClient
+from lxml import etree
+from pymongo import ReplaceOne, UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError
+from strategy import fetch
+from strategy.cusip import migrate_legacy_map
+from strategy.database import db
+from strategy.holdings import store_holdings, DUPLICATE_KEY
 
 
-client = MongoClient(environ['MONGODB_URI'])
-db = client.get_database()
 MIN_13F_DATE = '2014-01-01'
 
 
@@ -17,6 +20,9 @@ class SecurityType(Enum):
 
 
 class Form13F:
+    __slots__ = ('cik', 'name', 'sec_id', 'date', 'link', 'holdings', 'share_val', 'total_val', 'num_holdings',
+                 'gain')
+
     def __init__(self, cik, sec_id, name, date, link, holdings):
         self.cik = cik
         self.name = name
@@ -29,6 +35,9 @@ class Form13F:
         self.num_holdings = len(holdings)
         self.gain = False
 
+    def to_document(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
 
 class WebScrapeError(RuntimeError):
     pass
@@ -57,18 +66,64 @@ def valid_cusip(cusip):   # For more information, see: https://en.wikipedia.org/
         return False
 
 
-def cusip_to_ticker(cusip):
+def normalize_cusip(cusip):
     if len(cusip) < 9:
         cusip = '0'*(9 - len(cusip)) + cusip
     cusip = cusip.upper()
     if not valid_cusip(cusip):
         print('WARNING/ED: CUSIP did not match checksum: ' + cusip)
-    cusip_map = db.cusipmap.find_one()
-    if cusip not in cusip_map:
-        print("WARNING/ED: Could not find '" + cusip + "' in CUSIP mapping. Adding as CUSIP.")
-        db.bad_cusip.replace_one({'cusip': cusip}, {'cusip': cusip}, upsert=True)
-        return cusip
-    return cusip_map[cusip]
+    return cusip
+
+
+class CusipResolver:
+    def __init__(self):
+        self.cusip_map = {}
+        self.version = None
+        self.loaded = False
+        self.bad_cusips = set()
+        self.lock = Lock()
+
+    def refresh(self):
+        with self.lock:
+            if not self.loaded and db.cusips.find_one({}, {'_id': 1}) is None:
+                migrate_legacy_map()    # Deployments that still only have the single-document map
+            meta = db.versions.find_one({'name': 'cusips'}, {'version': 1})
+            version = meta.get('version') if meta is not None else None
+            if self.loaded and version == self.version:
+                return
+            cusip_map = {row['cusip']: row['ticker'] for row in db.cusips.find({}, {'_id': 0, 'cusip': 1, 'ticker': 1})}
+            self.cusip_map = cusip_map
+            self.version = version
+            self.loaded = True
+            print("EDGAR: Loaded " + str(len(cusip_map)) + " CUSIP mappings (version " + str(version) + ")")
+
+    def lookup(self, cusip):
+        if not self.loaded:
+            self.refresh()
+        cusip = normalize_cusip(cusip)
+        ticker = self.cusip_map.get(cusip)
+        if ticker is None:
+            print("WARNING/ED: Could not find '" + cusip + "' in CUSIP mapping. Adding as CUSIP.")
+            with self.lock:
+                self.bad_cusips.add(cusip)
+            return cusip
+        return ticker
+
+    def flush_bad_cusips(self):
+        with self.lock:     # Filings are parsed on fetch worker threads
+            bad_cusips, self.bad_cusips = self.bad_cusips, set()
+        if bad_cusips:
+            db.bad_cusip.bulk_write([ReplaceOne({'cusip': cusip}, {'cusip': cusip}, upsert=True)
+                                     for cusip in sorted(bad_cusips)], ordered=False)
+
+
+cusip_resolver = CusipResolver()
+
+
+def cusip_to_ticker(cusip):
+    ticker = cusip_resolver.lookup(cusip)
+    cusip_resolver.flush_bad_cusips()
+    return ticker
 
 
 def aggregate_holdings(holdings):
@@ -78,27 +133,37 @@ def aggregate_holdings(holdings):
     return out
 
 
-def get_holdings(xml):
-    holdings = {SecurityType.SHARE: {}, SecurityType.PUT: {}, SecurityType.CALL: {}}
-    for holding in xml("infoTable"):
-        ticker = cusip_to_ticker(str(holding.find("cusip").string))
+def iter_info_table(source):
+    for _, element in etree.iterparse(source, events=('end',), tag='{*}infoTable', huge_tree=True):
+        fields = {}
+        for child in element.iter(etree.Element):
+            fields.setdefault(etree.QName(child).localname, child.text)
         security_type = SecurityType.SHARE
-        if holding.find("putCall") is not None:
-            if str(holding.find("putCall").string).upper() == 'PUT':
-                security_type = SecurityType.PUT
-            elif str(holding.find("putCall").string).upper() == 'CALL':
-                security_type = SecurityType.CALL
-        name = str(holding.find("nameOfIssuer").string).title().replace(" New", "")
-        value = int(holding.find("value").string)
-        units = int(holding.find("sshPrnamt").string)
+        put_call = str(fields.get('putCall')).upper()
+        if put_call == 'PUT':
+            security_type = SecurityType.PUT
+        elif put_call == 'CALL':
+            security_type = SecurityType.CALL
+        yield (str(fields.get('cusip')), security_type, str(fields.get('nameOfIssuer')),
+               int(fields['value']), int(fields['sshPrnamt']))
+        element.clear()     # Drop parsed rows so memory stays flat on very large information tables
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
 
+def get_holdings(source):
+    holdings = {SecurityType.SHARE: {}, SecurityType.PUT: {}, SecurityType.CALL: {}}
+    cusip_resolver.refresh()    # Cheap version check, the full map is only reloaded after update_cusip
+    for cusip, security_type, name, value, units in iter_info_table(source):
+        ticker = cusip_resolver.lookup(cusip)
         if holdings[security_type].get(ticker) is not None:
             holdings[security_type][ticker]['value'] += value
             holdings[security_type][ticker]['units'] += units
         else:
-            holdings[security_type][ticker] = {"ticker": ticker, "name": name,
+            holdings[security_type][ticker] = {"ticker": ticker, "name": name.title().replace(" New", ""),
                                                "security_type": security_type.name.title(),
                                                "value": value, "units": units}
+    cusip_resolver.flush_bad_cusips()
     return aggregate_holdings(holdings)
 
 
@@ -106,6 +171,10 @@ def already_in_db(sec_id):
     return db.forms.find_one({'sec_id': sec_id}) is not None
 
 
+def stored_sec_ids(sec_ids):
+    return {form['sec_id'] for form in db.forms.find({'sec_id': {'$in': list(sec_ids)}}, {'sec_id': 1})}
+
+
 def get_link_and_date(soup):
     date_header = soup.select("div.formGrouping > div:nth-of-type(1)")[0].string
     if date_header != "Filing Date":
@@ -121,65 +190,129 @@ def get_link_and_date(soup):
     return "https://www.sec.gov" + form_link, date
 
 
+def changed_gains(forms):   # Forms sorted by date, each gaining against the last form from an earlier date
+    changed = []
+    previous_total = None
+    last_date = None
+    last_total = None
+    for form in forms:
+        if form['date'] != last_date:
+            previous_total = last_total
+            last_date = form['date']
+        last_total = form['total_val']
+        if previous_total is not None:
+            gain = form['total_val'] - previous_total
+            if form.get('gain') is False or form.get('gain') != gain:
+                changed.append((form['_id'], gain))
+    return changed
+
+
 def update_gains(cik):
-    dates = [form['date'] for form in db.forms.find({"cik": cik})]
-    for form in db.forms.find({"cik": cik}):
-        if not form['gain']:
-            before_dates = [date for date in dates if date < form['date']]
-            if before_dates:
-                before_date = max(before_dates)
-                last_form = db.forms.find_one({'cik': cik, 'date': before_date})
-                gain = form['total_val'] - last_form['total_val']
-                db.forms.update_one({'_id': form['_id']}, {'$set': {'gain': gain}})
+    forms = db.forms.find({'cik': cik, 'date': {'$exists': True}}, {'date': 1, 'total_val': 1, 'gain': 1})
+    changed = changed_gains(forms.sort('date', ASCENDING))
+    if changed:
+        db.forms.bulk_write([UpdateOne({'_id': _id}, {'$set': {'gain': gain}}) for _id, gain in changed],
+                            ordered=False)
 
 
-def add_filings(cik, filing_links, count, name):
-    updated = False
-    added = 0
+def select_filings(filing_links, count):
+    selected = []
     for filing in filing_links:
-        sec_id = filing.get('href').split("/")[5]
-
-        if added == count:
+        if len(selected) == count:
             break
         if '[Amend]' in str(filing.parent.parent):
             continue
+        selected.append((filing.get('href').split("/")[5], "https://www.sec.gov" + filing.get("href")))
+    return selected
 
-        if not already_in_db(sec_id):
-            url = "https://www.sec.gov" + filing.get("href")
-            soup = BeautifulSoup(requests.get(url).content, "html.parser")
-            print("REQUEST/ED: 13F filing links page " + url)
-            link, date = get_link_and_date(soup)
-            if link is not None:
-                updated = True
-                xml = BeautifulSoup(requests.get(link).content, "xml")
-                print("REQUEST/ED: 13F filing XML")
-                holdings = get_holdings(xml)
-                form = Form13F(cik, sec_id, name, date, link, holdings)
-                db.forms.insert_one(form.__dict__)
-                print("EDGAR: Added form: " + sec_id + " for " + cik)
-            else:
-                db.forms.insert_one({'sec_id': sec_id})
-                print("WARNING/ED: Form missing from EDGAR: " + sec_id + " for " + cik)
-        added += 1
-    return updated
 
+def fetch_form(cik, sec_id, url, name):
+    soup = BeautifulSoup(fetch.sec_get(url).content, "html.parser")
+    print("REQUEST/ED: 13F filing links page " + url)
+    link, date = get_link_and_date(soup)
+    if link is None:
+        return sec_id, None
+    with fetch.sec_stream(link) as stream:
+        print("REQUEST/ED: 13F filing XML")
+        holdings = get_holdings(stream)
+    return sec_id, Form13F(cik, sec_id, name, date, link, holdings)
 
-def update_filings(cik, count=20):
-    if count > 40:
-        raise ValueError("Cannot get more than 40 filings - XML data may not be available that far back")
+
+def store_forms(cik, jobs):
+    documents = []
+    for sec_id, job in jobs:
+        try:
+            form = job.result()[1]
+        except Exception as e:  # Left unstored so the next run retries it, and the other filings still save
+            print("WARNING/ED: Could not fetch form " + sec_id + " for " + cik + ": " + repr(e))
+            continue
+        if form is not None:
+            documents.append(form.to_document())
+            print("EDGAR: Added form: " + sec_id + " for " + cik)
+        else:
+            documents.append({'sec_id': sec_id})
+            print("WARNING/ED: Form missing from EDGAR: " + sec_id + " for " + cik)
+    try:
+        if documents:
+            db.forms.insert_many(documents, ordered=False)
+    except BulkWriteError as e:     # Another run stored some of the same filings first
+        if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+    stored = [document for document in documents if 'cik' in document]
+    store_holdings(stored)
+    return bool(stored)
+
+
+def submit_filings(cik, filing_links, count, name):
+    selected = select_filings(filing_links, count)
+    stored = stored_sec_ids(sec_id for sec_id, _ in selected)
+    return [(sec_id, fetch.submit(fetch_form, cik, sec_id, url, name)) for sec_id, url in selected
+            if sec_id not in stored]
+
+
+def add_filings(cik, filing_links, count, name):
+    return store_forms(cik, submit_filings(cik, filing_links, count, name))
+
+
+def get_company_page(cik, count):
     company_url = "https://www.sec.gov/cgi-bin/browse-edgar?action=getcompany&CIK=" + \
                   cik + "&type=13F&dateb=&owner=include&count=" + str(count)
-    soup = BeautifulSoup(requests.get(company_url).content, "html.parser")
+    soup = BeautifulSoup(fetch.sec_get(company_url).content, "html.parser")
     print("REQUEST/ED: 13F filing company page " + cik)
-    if soup.select(".companyName"):
-        company_string = soup.select(".companyName")[0].text
-    else:
-        return False
-    name = company_string.split(" CIK")[0].title()
-    filing_links = soup("a", id="documentsbutton")
-    updated = add_filings(cik, filing_links, count, name)
+    return soup
+
+
+def update_company(cik, name):
     update_gains(cik)
     if db.companies.find_one({"name": name, "cik": cik}) is None \
             and db.forms.find_one({'$and': [{'cik': cik}, {'date': {"$exists": True}}]}) is not None:
         db.companies.insert_one({"name": name, "cik": cik})
+        # Lets every app process notice the new company without rereading the list each request
+        db.versions.update_one({'name': 'companies'}, {'$inc': {'version': 1}}, upsert=True)
+
+
+def update_all_filings(ciks, count=20):
+    if count > 40:
+        raise ValueError("Cannot get more than 40 filings - XML data may not be available that far back")
+    pages = [(cik, fetch.submit(get_company_page, cik, count)) for cik in ciks]
+    names = {}
+    jobs = {}
+    for cik, page in pages:     # Filings are queued as each company page arrives, so CIKs overlap
+        try:
+            soup = page.result()
+        except Exception as e:  # Skipped so the other companies' filings still get stored
+            print("WARNING/ED: Could not fetch company page " + cik + ": " + repr(e))
+            continue
+        if not soup.select(".companyName"):
+            continue
+        names[cik] = soup.select(".companyName")[0].text.split(" CIK")[0].title()
+        jobs[cik] = submit_filings(cik, soup("a", id="documentsbutton"), count, names[cik])
+    updated = {cik: False for cik in ciks}
+    for cik, cik_jobs in jobs.items():
+        updated[cik] = store_forms(cik, cik_jobs)
+        update_company(cik, names[cik])
     return updated
+
+
+def update_filings(cik, count=20):
+    return update_all_filings([cik], count)[cik]
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import hashlib
+from os import environ
+from threading import Lock, get_ident
+from contextlib import contextmanager
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+MAX_WORKERS = int(environ.get('FETCH_WORKERS', 8))
+SEC_RATE = 8        # SEC asks for no more than 10 requests per second
+SEC_BURST = 2       # Rate plus burst stays under that cap in any one second window
+TIMEOUT = 30
+USER_AGENT = environ.get('USER_AGENT', 'HedgeForm')
+CACHE_DIR = environ.get('HTTP_CACHE_DIR')     # Responses are only cached on disk when this is set
+CACHE_MAX_BYTES = int(environ.get('HTTP_CACHE_MAX_MB', 2048)) * 1024 * 1024
+CACHE_OFFLINE = environ.get('HTTP_CACHE_OFFLINE') == '1'
+LISTING_TTL = 6 * 60 * 60
+PRICE_TTL = 12 * 60 * 60
+CHUNK_SIZE = 64 * 1024
+
+
+class CacheMiss(ConnectionError):
+    pass
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CachedResponse:
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+sec_limiter = RateLimiter(SEC_RATE, SEC_BURST)
+session = requests.Session()
+session.headers['User-Agent'] = USER_AGENT
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS))
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+cache_lock = Lock()
+cache_size = None
+
+
+def cache_key(url, params=None):
+    params = sorted((key, str(value)) for key, value in (params or {}).items() if key != 'token')
+    return hashlib.sha256((url + '?' + urlencode(params)).encode()).hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+
+def cache_ttl(url):
+    if '/Archives/' in url:
+        return None     # Filed documents never change once published
+    if 'browse-edgar' in url:
+        return LISTING_TTL
+    return PRICE_TTL
+
+
+def cache_lookup(url, params=None):     # An open file, which stays readable even if evicted afterwards
+    path = cache_path(cache_key(url, params))
+    try:
+        stat = os.stat(path)
+        ttl = cache_ttl(url)
+        if not CACHE_OFFLINE and ttl is not None and time.time() - stat.st_mtime > ttl:
+            return None
+        file = open(path, 'rb')
+    except FileNotFoundError:   # Never stored, or evicted by another thread since
+        if CACHE_OFFLINE:
+            raise CacheMiss("Offline and not cached: " + url)
+        return None
+    try:
+        os.utime(path, (time.time(), stat.st_mtime))    # atime tracks use for eviction, mtime keeps the fetch time
+    except FileNotFoundError:
+        pass
+    return file
+
+
+def cache_evict():
+    entries = []
+    for root, _, names in os.walk(CACHE_DIR):
+        for name in names:
+            if not name.endswith('.tmp'):
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:   # Evicted by another worker process sharing the cache
+                    continue
+                entries.append((stat.st_atime, stat.st_size, os.path.join(root, name)))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES * 0.9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
+
+
+def cache_store(url, params, chunks):
+    global cache_size
+    path = cache_path(cache_key(url, params))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.' + str(os.getpid()) + '-' + str(get_ident()) + '.tmp'   # Unique across worker processes
+    size = 0
+    with open(temp_path, 'wb') as file:
+        for chunk in chunks:
+            file.write(chunk)
+            size += len(chunk)
+    os.replace(temp_path, path)
+    with cache_lock:
+        cache_size = cache_evict() if cache_size is None else cache_size + size
+        if cache_size > CACHE_MAX_BYTES:
+            cache_size = cache_evict()
+    return path
+
+
+def request(url, limiter=None, **kwargs):
+    if CACHE_OFFLINE:
+        raise CacheMiss("Offline and not cached: " + url)
+    if limiter is not None:
+        limiter.acquire()
+    return session.get(url, timeout=TIMEOUT, **kwargs)
+
+
+def get(url, limiter=None, params=None):
+    if CACHE_DIR is None:
+        return request(url, limiter, params=params)
+    cached = cache_lookup(url, params)
+    if cached is not None:
+        with cached:
+            return CachedResponse(cached.read())
+    response = request(url, limiter, params=params)
+    if response.status_code == 200:
+        cache_store(url, params, [response.content])
+    return response
+
+
+@contextmanager
+def open_stream(url, limiter=None):
+    stream = cache_lookup(url) if CACHE_DIR is not None else None
+    if stream is None:
+        with request(url, limiter, stream=True) as response:
+            if CACHE_DIR is None or response.status_code != 200:
+                response.raw.decode_content = True
+                yield response.raw
+                return
+            path = cache_store(url, None, response.iter_content(CHUNK_SIZE))
+            with cache_lock:    # Evictions hold the lock, so the new file is still there
+                stream = open(path, 'rb')
+    with stream:
+        yield stream
+
+
+def sec_get(url):
+    return get(url, limiter=sec_limiter)
+
+
+def sec_stream(url):
+    return open_stream(url, limiter=sec_limiter)
+
+
+def submit(fn, *args):
+    return executor.submit(fn, *args)
@@ -0,0 +1,59 @@
+from os import environ
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+from strategy.database import db
+from strategy.dashboard import latest_forms
+from strategy.indexes import ensure_indexes
+
+STORE_HOLDINGS = environ.get('STORE_HOLDINGS', '1') == '1'   # Set to 0 to keep holdings embedded in forms only
+HOLDING_FIELDS = {'_id': 0, 'cik': 1, 'sec_id': 1, 'date': 1, 'ticker': 1, 'name': 1, 'security_type': 1,
+                  'value': 1, 'units': 1}
+DUPLICATE_KEY = 11000
+
+
+def holding_documents(form):
+    return [{'cik': form['cik'], 'sec_id': form['sec_id'], 'date': form['date'], 'ticker': holding['ticker'],
+             'name': holding['name'], 'security_type': holding['security_type'], 'value': holding['value'],
+             'units': holding['units']} for holding in form['holdings']]
+
+
+def store_holdings(forms):
+    documents = [document for form in forms for document in holding_documents(form)]
+    if not STORE_HOLDINGS or not documents:
+        return 0
+    try:
+        return len(db.holdings.insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as e:     # Rows already stored by an earlier run are fine
+        if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+        return e.details['nInserted']
+
+
+def backfill_holdings():
+    ensure_indexes(['holdings'])
+    stored = set(db.holdings.distinct('sec_id'))
+    added = 0
+    for form in db.forms.find({'date': {'$exists': True}}, {'_id': 0, 'cik': 1, 'sec_id': 1, 'date': 1,
+                                                            'holdings': 1}):
+        if form['sec_id'] not in stored:
+            added += store_holdings([form])
+    print("HOLDINGS: Backfilled " + str(added) + " holdings")
+    return added
+
+
+def holders(ticker):    # Each manager whose latest filing holds the ticker
+    latest = [form['sec_id'] for form in latest_forms(db.companies.distinct('cik'), ['sec_id'])]
+    return list(db.holdings.find({'ticker': ticker, 'sec_id': {'$in': latest}}, HOLDING_FIELDS))
+
+
+def added_by(ticker, since):    # Managers holding the ticker in a filing since the date but not in the one before
+    found = {}
+    recent = db.holdings.find({'ticker': ticker, 'date': {'$gte': since}}, HOLDING_FIELDS)
+    for holding in recent.sort('date', ASCENDING):
+        found.setdefault(holding['cik'], holding)
+    previous = db.forms.aggregate([{'$match': {'cik': {'$in': list(found)}, 'date': {'$lt': since}}},
+                                   {'$sort': {'cik': 1, 'date': -1}},
+                                   {'$group': {'_id': '$cik', 'sec_id': {'$first': '$sec_id'}}}])
+    previous = [form['sec_id'] for form in previous]
+    held = {holding['cik'] for holding in db.holdings.find({'ticker': ticker, 'sec_id': {'$in': previous}}, {'cik': 1})}
+    return [holding for cik, holding in found.items() if cik not in held]
@@ -0,0 +1,110 @@
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from strategy.database import db
+
+
+# Collection to (keys, unique) pairs backing the hot queries in app, worker, edgar and the backtesters
+INDEXES = {
+    'forms': [([('sec_id', ASCENDING)], True),
+              ([('cik', ASCENDING), ('date', DESCENDING)], False)],
+    'companies': [([('name', ASCENDING), ('cik', ASCENDING)], True),
+                  ([('cik', ASCENDING)], False)],
+    'backtest': [([('cik', ASCENDING)], True)],
+    'backtest_checkpoints': [([('cik', ASCENDING), ('num_stocks', ASCENDING), ('data_version', ASCENDING)], True)],
+    'prices': [([('name', ASCENDING)], True)],
+    'stockdata': [([('name', ASCENDING)], False)],
+    'holdings': [([('cik', ASCENDING), ('sec_id', ASCENDING), ('ticker', ASCENDING), ('security_type', ASCENDING)],
+                  True),
+                 ([('ticker', ASCENDING), ('date', DESCENDING)], False),
+                 ([('cik', ASCENDING), ('date', DESCENDING)], False)],
+    'dashboard': [([('cik', ASCENDING)], True)],
+    'cusips': [([('cusip', ASCENDING)], True)],
+    'cusipfiles': [([('name', ASCENDING)], True)],
+    'bad_cusip': [([('cusip', ASCENDING)], True)],
+    'versions': [([('name', ASCENDING)], True)],
+}
+
+
+def ensure_indexes(collections=None):
+    for collection in collections or INDEXES:
+        for keys, unique in INDEXES[collection]:
+            try:
+                db[collection].create_index(keys, unique=unique)
+            except OperationFailure as e:   # Usually duplicates left from before the index existed
+                print("WARNING/IX: Could not index " + collection + " on " + str(keys) + ": " + str(e))
+    print("INDEXES: Ensured indexes on " + str(len(collections or INDEXES)) + " collections")
+
+
+def sample_values():    # Real keys so the planner sees the same shapes as live queries
+    company = db.companies.find_one({}, {'cik': 1}) or {'cik': ''}
+    form = db.forms.find_one({'cik': company['cik'], 'date': {'$exists': True}}, {'sec_id': 1}) or {'sec_id': ''}
+    price = db.prices.find_one({}, {'name': 1}) or {'name': ''}
+    return company['cik'], form['sec_id'], price['name']
+
+
+def audited_queries():
+    cik, sec_id, ticker = sample_values()
+    return [
+        ('forms by cik', 'forms', {'filter': {'cik': cik}}),
+        ('form by cik and sec_id', 'forms', {'filter': {'cik': cik, 'sec_id': sec_id}}),
+        ('forms by sec_id list', 'forms', {'filter': {'sec_id': {'$in': [sec_id]}}}),
+        ('forms by cik and date', 'forms', {'filter': {'cik': cik, 'date': {'$exists': True}}, 'sort': {'date': 1}}),
+        ('latest forms', 'forms', {'pipeline': [{'$match': {'cik': {'$in': [cik]}, 'date': {'$exists': True}}},
+                                                {'$sort': {'cik': 1, 'date': -1}},
+                                                {'$group': {'_id': '$cik', 'date': {'$first': '$date'}}}]}),
+        ('company by name and cik', 'companies', {'filter': {'name': '', 'cik': cik}}),
+        ('companies by cik', 'companies', {'filter': {'cik': {'$in': [cik]}}}),
+        ('backtest by cik', 'backtest', {'filter': {'cik': cik}}),
+        ('checkpoints', 'backtest_checkpoints', {'filter': {'cik': cik, 'num_stocks': {'$in': [5]},
+                                                            'data_version': {'$in': ['']}}}),
+        ('prices by name', 'prices', {'filter': {'name': {'$in': [ticker]}}}),
+        ('legacy prices by name', 'stockdata', {'filter': {'name': {'$in': [ticker]},
+                                                           'history': {'$exists': True}}}),
+        ('holdings by ticker', 'holdings', {'filter': {'ticker': ticker, 'sec_id': {'$in': [sec_id]}}}),
+        ('holdings by ticker and date', 'holdings', {'filter': {'ticker': ticker, 'date': {'$gte': ''}},
+                                                     'sort': {'date': 1}}),
+        ('version counter', 'versions', {'filter': {'name': 'companies'}}),
+    ]
+
+
+def plan_stages(plan):
+    stages = [plan['stage']] if 'stage' in plan else []
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        stages += plan_stages(child)
+    return stages
+
+
+def winning_plans(explained):   # Aggregations nest the find plan inside their first stage
+    if 'queryPlanner' in explained:
+        return [explained['queryPlanner']['winningPlan']]
+    plans = []
+    for stage in explained.get('stages', []):
+        if '$cursor' in stage:
+            plans += winning_plans(stage['$cursor'])
+    return plans
+
+
+def explain_query(collection, query):
+    if 'pipeline' in query:
+        return db.command('aggregate', collection, pipeline=query['pipeline'], explain=True)
+    cursor = db[collection].find(query['filter'])
+    if 'sort' in query:
+        cursor = cursor.sort(list(query['sort'].items()))
+    return cursor.explain()
+
+
+def audit_queries():
+    queries = audited_queries()
+    scans = []
+    for name, collection, query in queries:
+        stages = [stage for plan in winning_plans(explain_query(collection, query)) for stage in plan_stages(plan)]
+        if 'COLLSCAN' in stages:
+            scans.append(name)
+            print("WARNING/IX: Collection scan for " + name + " on " + collection)
+        else:
+            print("INDEXES: " + name + " on " + collection + " uses " + " <- ".join(stages))
+    print("INDEXES: Audited " + str(len(queries)) + " queries, " + str(len(scans)) + " collection scans")
+    return scans
@@ -0,0 +1,210 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date as Date, datetime
+from os import environ
+from threading import Lock
+from pymongo import ReturnDocument
+from strategy.database import db
+
+CACHE_MAX_POINTS = int(environ.get('PRICE_CACHE_POINTS', 4000000))    # 12 bytes a point, so about 48 MB
+TAIL_MAX_POINTS = 250   # Appended rows kept as plain arrays until they are folded into the binary ones
+
+
+def to_day(date):
+    return datetime.strptime(date, '%Y-%m-%d').toordinal()
+
+
+def from_day(day):
+    return Date.fromordinal(day).isoformat()
+
+
+class PriceSeries:
+    def __init__(self, name, days=None, opens=None, revision=0, tail=0):
+        self.name = name
+        self.days = days if days is not None else array('i')     # Sorted proleptic ordinals
+        self.opens = opens if opens is not None else array('d')
+        self.revision = revision
+        self.tail = tail    # Rows stored in the appendable tail arrays rather than the binary ones
+
+    @classmethod
+    def from_history(cls, name, history, revision=0):
+        series = cls(name, revision=revision)
+        for date in sorted(history):
+            series.days.append(to_day(date))
+            series.opens.append(float(history[date]))
+        return series
+
+    @classmethod
+    def from_document(cls, document):
+        days = array('i')
+        days.frombytes(document['days'])
+        opens = array('d')
+        opens.frombytes(document['opens'])
+        series = cls(document['name'], days, opens, document.get('revision', 0), len(document.get('tail_days', [])))
+        # Workers appending from stale copies can push the same day twice, and the later push wins
+        series.extend_days(dict(zip(document.get('tail_days', []), document.get('tail_opens', []))).items())
+        return series
+
+    def copy(self):
+        return PriceSeries(self.name, array('i', self.days), array('d', self.opens), self.revision, self.tail)
+
+    def arrays(self):
+        return {'days': self.days.tobytes(), 'opens': self.opens.tobytes(), 'last_date': self.last_date()}
+
+    def __len__(self):
+        return len(self.days)
+
+    def last_date(self):
+        return from_day(self.days[-1]) if self.days else None
+
+    def open_on(self, date):
+        day = to_day(date)
+        i = bisect_left(self.days, day)
+        if i < len(self.days) and self.days[i] == day:
+            return self.opens[i]
+        return None
+
+    def as_of(self, date):   # Last open on or before the date, with the date it came from
+        i = bisect_right(self.days, to_day(date))
+        if i == 0:
+            return None, None
+        return from_day(self.days[i - 1]), self.opens[i - 1]
+
+    def extend(self, history):
+        self.extend_days((to_day(date), float(price)) for date, price in history.items())
+
+    def extend_days(self, rows):
+        new_days = sorted(rows)
+        if not new_days:
+            return
+        if not self.days or new_days[0][0] > self.days[-1]:
+            for day, price in new_days:
+                self.days.append(day)
+                self.opens.append(price)
+            return
+        merged = dict(zip(self.days, self.opens))
+        merged.update(new_days)
+        self.days = array('i', sorted(merged))
+        self.opens = array('d', (merged[day] for day in self.days))
+
+
+class SeriesCache:
+    def __init__(self, max_points):
+        self.max_points = max_points
+        self.points = 0
+        self.series = OrderedDict()     # Least recently used first, None marks a ticker with no data
+        self.lock = Lock()
+
+    def get_many(self, tickers):
+        found = {}
+        missing = []
+        with self.lock:
+            for ticker in tickers:
+                if ticker in self.series:
+                    self.series.move_to_end(ticker)
+                    found[ticker] = self.series[ticker]
+                else:
+                    missing.append(ticker)
+        if missing:
+            loaded = load_many(missing)
+            for ticker in missing:
+                found[ticker] = loaded.get(ticker)
+                self.put(ticker, found[ticker])
+        return {ticker: series for ticker, series in found.items() if series is not None}
+
+    def put(self, ticker, series):
+        with self.lock:
+            self.discard(ticker)
+            self.series[ticker] = series
+            self.points += len(series) if series is not None else 0
+            while self.points > self.max_points and len(self.series) > 1:
+                _, evicted = self.series.popitem(last=False)
+                self.points -= len(evicted) if evicted is not None else 0
+
+    def discard(self, ticker):
+        evicted = self.series.pop(ticker, None)
+        self.points -= len(evicted) if evicted is not None else 0
+
+
+cache = SeriesCache(CACHE_MAX_POINTS)
+
+
+def cached_many(tickers):
+    return cache.get_many(tickers)
+
+
+def cached_series(ticker):
+    return cache.get_many([ticker]).get(ticker)
+
+
+def migrate_legacy(tickers):     # Builds columnar series from old {'history': {date: open}} documents
+    series = {}
+    for data in db.stockdata.find({'name': {'$in': list(tickers)}, 'history': {'$exists': True}}):
+        series[data['name']] = save_history(data['name'], data['history'])
+    return series
+
+
+def load_many(tickers):
+    tickers = list(tickers)
+    series = {document['name']: PriceSeries.from_document(document)
+              for document in db.prices.find({'name': {'$in': tickers}})}
+    missing = [ticker for ticker in tickers if ticker not in series]
+    if missing:
+        series.update(migrate_legacy(missing))
+    return series
+
+
+def load_series(ticker):
+    return load_many([ticker]).get(ticker)
+
+
+def last_dates(tickers):
+    stored = db.prices.find({'name': {'$in': list(tickers)}}, {'name': 1, 'last_date': 1})
+    dates = {document['name']: document.get('last_date') for document in stored}
+    missing = [ticker for ticker in tickers if ticker not in dates]
+    if missing:
+        dates.update({name: series.last_date() for name, series in migrate_legacy(missing).items()})
+    return dates
+
+
+def revisions(tickers):
+    stored = db.prices.find({'name': {'$in': list(tickers)}}, {'name': 1, 'revision': 1})
+    return {document['name']: document.get('revision', 0) for document in stored}
+
+
+def save_history(ticker, history):   # Full rewrite, bumps the revision since earlier prices may have moved
+    series = PriceSeries.from_history(ticker, history)
+    document = db.prices.find_one_and_update({'name': ticker}, {'$set': series.arrays(), '$inc': {'revision': 1},
+                                                                '$unset': {'tail_days': '', 'tail_opens': ''}},
+                                             projection={'revision': 1}, upsert=True,
+                                             return_document=ReturnDocument.AFTER)
+    series.revision = document['revision']
+    cache.put(ticker, series)
+    return series
+
+
+def append_history(ticker, history, series=None):    # Pass the series the caller already holds to skip a reload
+    series = series or load_series(ticker)
+    if series is None:
+        return save_history(ticker, history)
+    rows = sorted((to_day(date), float(price)) for date, price in history.items())
+    if not rows:
+        return series
+    series = series.copy()  # Readers may still hold the cached one
+    appended = not series.days or rows[0][0] > series.days[-1]
+    series.extend_days(rows)
+    if appended and series.tail + len(rows) <= TAIL_MAX_POINTS:
+        # Only the new rows go over the wire; the binary arrays are rewritten once the tail fills up
+        db.prices.update_one({'name': ticker}, {'$push': {'tail_days': {'$each': [day for day, _ in rows]},
+                                                          'tail_opens': {'$each': [price for _, price in rows]}},
+                                                '$max': {'last_date': series.last_date()}})
+        series.tail += len(rows)
+    else:   # Rare, so reread first in case another worker appended since the caller's copy was loaded
+        series = load_series(ticker)
+        series.extend_days(rows)
+        db.prices.update_one({'name': ticker}, {'$set': series.arrays(),
+                                                '$unset': {'tail_days': '', 'tail_opens': ''}})
+        series.tail = 0
+    cache.put(ticker, series)
+    return series
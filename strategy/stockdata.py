@@ -1,14 +1,18 @@
-import requests
 from os import environ
 from datetime import datetime, timedelta
-from pymongo import MongoClient
+from threading import Lock
+from strategy import fetch, pricestore
+from strategy.tradingdays import TradingCalendar
 
 DATA_API_URL = 'https://api.tiingo.com/tiingo/daily/'
-API_KEY = environ['TIINGO_API']
 TRADING_CANARIES = ['AAPL', 'WMT']
 MIN_DATE = '2014-01-01'
-client = MongoClient(environ['MONGODB_URI'])
-db = client.get_database()
+calendar = None
+calendar_lock = Lock()
+
+
+def api_key():    # Read on use so modules import without a Tiingo key
+    return environ['TIINGO_API']
 
 
 class DataError(RuntimeError):
@@ -20,58 +24,88 @@ class APIError(ConnectionError):
 
 
 def specific_open(ticker, date):
-    data = db.stockdata.find_one({'$and': [{'name': ticker}, {'history.' + date: {"$exists": True}}]})
-    if data is not None:
-        return data['history'].get(date)
+    series = pricestore.cached_series(ticker)
+    if series is not None:
+        return series.open_on(date)
     else:
         return None
 
 
-def data_request(params, ticker):
+def price_request(params, ticker):
     url = DATA_API_URL + ticker + "/prices"
-    raw_data = requests.get(url, params=params).json()
+    raw_data = fetch.get(url, params=params).json()
     print("REQUEST/API: Stock data for " + ticker)
-    if isinstance(raw_data, list) and len(raw_data) < 2:
-        print("WARNING/SD: Error with " + ticker + " request: " + raw_data[0][:20] if len(raw_data) > 0 else None)
-        raise APIError()
     if isinstance(raw_data, dict) and raw_data.get("detail") is not None:
         print(" WARNING/SD: Error with " + ticker + " request: " + raw_data.get("detail"))
         raise APIError()
-    data = {'name': ticker, 'history': {}}
-    for datum in raw_data:
-        data['history'][datum['date'][:10]] = datum['adjOpen']
-    return data
+    if isinstance(raw_data, list) and any(not isinstance(datum, dict) for datum in raw_data):
+        print("WARNING/SD: Error with " + ticker + " request: " + str(raw_data[0])[:20])
+        raise APIError()
+    return raw_data
+
+
+def price_history(raw_data):
+    return {datum['date'][:10]: datum['adjOpen'] for datum in raw_data}
+
+
+def has_corporate_action(raw_data):   # Dividends and splits rescale every earlier adjusted price
+    return any(datum.get('divCash', 0) != 0 or datum.get('splitFactor', 1) != 1 for datum in raw_data)
+
+
+def data_request(params, ticker):
+    raw_data = price_request(params, ticker)
+    if len(raw_data) < 2:
+        print("WARNING/SD: Error with " + ticker + " request: not enough data")
+        raise APIError()
+    return {'name': ticker, 'history': price_history(raw_data)}
 
 
 def recent_open(ticker, date):
-    data = db.stockdata.find_one({'name': ticker})
-    if data is None:
-        return None
-    if data['history'].get(date) is not None:
-        return data['history'][date]
-    dates = [hist_date for hist_date in data['history'].keys() if hist_date < date]
-    if dates:
-        before_date = max(dates)
-        return data['history'].get(before_date)    # The closest open price before the supplied date
-    else:
-        return None
+    return open_as_of(ticker, date)[1]
+
+
+def open_as_of(ticker, date):
+    series = pricestore.cached_series(ticker)
+    if series is None:
+        return None, None
+    return series.as_of(date)   # The exact open price, or the closest one before the supplied date
 
 
 def already_in_db(ticker, date):
-    query = db.stockdata.find_one({'$and': [{'name': ticker},
-                                            {'history.' + date: {"$exists": True}}]})
-    return query is not None
+    return specific_open(ticker, date) is not None
+
+
+def stored_last_dates(tickers):
+    return pricestore.last_dates(tickers)
+
+
+def update_history(ticker, last_date, series=None):
+    if last_date is not None:
+        start_date = (datetime.strptime(last_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        raw_data = price_request({'token': api_key(), 'startDate': start_date}, ticker)
+        if not has_corporate_action(raw_data):
+            history = price_history(raw_data)
+            if history:
+                pricestore.append_history(ticker, history, series)
+            return history
+        print("STOCKDATA: Corporate action for " + ticker + " since " + last_date + ". Refreshing full history.")
+    data = data_request({'token': api_key(), 'startDate': MIN_DATE}, ticker)
+    pricestore.save_history(ticker, data['history'])
+    return data['history']
 
 
 def update_stock_db(tickers, date):
-    params = {'token': API_KEY, 'startDate': MIN_DATE}
-    trimmed = [ticker for ticker in tickers if not already_in_db(ticker, date)]
+    stored = pricestore.cached_many(tickers)
+    trimmed = [ticker for ticker in tickers if ticker not in stored or stored[ticker].open_on(date) is None]
     failed = []
     for ticker in trimmed:
+        last_date = stored[ticker].last_date() if ticker in stored else None
         try:
-            data = data_request(params, ticker)
-            db.stockdata.replace_one({'name': ticker}, data, upsert=True)
-            if data['history'].get(date) is None:
+            if last_date is not None and date <= last_date:
+                history = {}    # Stored history already covers this date, so there is nothing new to fetch
+            else:
+                history = update_history(ticker, last_date, stored.get(ticker))
+            if history.get(date) is None:
                 print(" WARNING/SD: Could not get data for " + ticker + " on: " + date)
                 failed.append(ticker)
         except APIError:
@@ -79,23 +113,75 @@ def update_stock_db(tickers, date):
     return failed
 
 
+def build_calendar():
+    global calendar
+    with calendar_lock:
+        calendar = TradingCalendar.from_series(pricestore.load_many(TRADING_CANARIES).values())
+        try:
+            calendar.save()
+        except OSError:
+            print("WARNING/SD: Could not save the trading calendar locally. It will be rebuilt next run.")
+    return calendar
+
+
+def trading_calendar():
+    global calendar
+    if calendar is None:
+        calendar = TradingCalendar.load() or build_calendar()
+    return calendar
+
+
 def update_trading_days():
+    last_dates = stored_last_dates(TRADING_CANARIES)
     for canary in TRADING_CANARIES:
-        params = {'token': API_KEY, 'startDate': MIN_DATE}
-        data = data_request(params, canary)
-        db.stockdata.replace_one({'name': canary}, data, upsert=True)
+        update_history(canary, last_dates.get(canary))
+    build_calendar()
 
 
 def next_trading_day(date):
-    next_date = datetime.strptime(date, '%Y-%m-%d')
-    for i in range(7):
-        next_date += timedelta(days=1)
-        for canary in TRADING_CANARIES:
-            query = db.stockdata.find_one({'$and': [{'name': canary},
-                                                    {'history.' + next_date.strftime('%Y-%m-%d'): {"$exists": True}}]})
-            if query is not None:
-                return next_date.strftime('%Y-%m-%d')
-    raise DataError("Either the stock market disappeared or you should update the trading days manually.")
+    next_date = trading_calendar().next_day(date)
+    if next_date is None or pricestore.to_day(next_date) - pricestore.to_day(date) > 7:
+        next_date = build_calendar().next_day(date)     # The saved calendar may predate the latest canary data
+    if next_date is None or pricestore.to_day(next_date) - pricestore.to_day(date) > 7:
+        raise DataError("Either the stock market disappeared or you should update the trading days manually.")
+    return next_date
+
+
+class PriceBook:
+    def __init__(self, tickers=()):
+        self.series = pricestore.load_many(tickers)    # One query for everything a backtest expects to touch
+        self.failed = {}    # Date to tickers that still had no open on that date after asking the API
+        self.available = {}     # Date to tickers already known to have an open on that date
+
+    def load(self, tickers):
+        missing = [ticker for ticker in tickers if ticker not in self.series]
+        if missing:
+            self.series.update(pricestore.cached_many(missing))
+
+    def has_open(self, ticker, date):
+        return ticker in self.series and self.series[ticker].open_on(date) is not None
+
+    def get_data(self, tickers, date):
+        self.load(tickers)
+        failed = self.failed.setdefault(date, set())
+        available = self.available.setdefault(date, set())
+        missing = [ticker for ticker in tickers
+                   if ticker not in failed and ticker not in available and not self.has_open(ticker, date)]
+        if missing:
+            failed.update(update_stock_db(missing, date))
+            self.series.update(pricestore.cached_many(missing))
+        available.update(ticker for ticker in tickers if ticker not in failed)
+        return [ticker for ticker in tickers if ticker in failed]
+
+    def revision(self, ticker):
+        self.load([ticker])
+        return self.series[ticker].revision if ticker in self.series else None
+
+    def open_as_of(self, ticker, date):
+        self.load([ticker])
+        if ticker not in self.series:
+            return None, None
+        return self.series[ticker].as_of(date)
 
 
 def get_data(tickers, date):
@@ -0,0 +1,59 @@
+import os
+import json
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
+from os import environ
+from strategy.pricestore import to_day, from_day
+
+CALENDAR_FILE = environ.get('TRADING_DAYS_FILE', os.path.join(tempfile.gettempdir(), 'hedgeform_trading_days.json'))
+
+
+class TradingCalendar:
+    def __init__(self, days):
+        self.days = array('i', sorted(set(days)))
+
+    @classmethod
+    def from_series(cls, series):   # A day counts as trading if any canary has an open on it
+        days = set()
+        for canary in series:
+            days.update(canary.days)
+        return cls(days)
+
+    @classmethod
+    def load(cls, path=CALENDAR_FILE):
+        try:
+            with open(path) as file:
+                return cls(json.load(file)['days'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, path=CALENDAR_FILE):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'days': self.days.tolist()}, file)
+        os.replace(temp_path, path)
+
+    def __len__(self):
+        return len(self.days)
+
+    def last_date(self):
+        return from_day(self.days[-1]) if self.days else None
+
+    def is_trading_day(self, date):
+        day = to_day(date)
+        i = bisect_left(self.days, day)
+        return i < len(self.days) and self.days[i] == day
+
+    def next_day(self, date):
+        i = bisect_right(self.days, to_day(date))
+        return from_day(self.days[i]) if i < len(self.days) else None
+
+    def previous_day(self, date):
+        i = bisect_left(self.days, to_day(date))
+        return from_day(self.days[i - 1]) if i > 0 else None
+
+    def between(self, start_date, end_date):    # Inclusive on both ends
+        start = bisect_left(self.days, to_day(start_date))
+        end = bisect_right(self.days, to_day(end_date))
+        return [from_day(day) for day in self.days[start:end]]
@@ -0,0 +1,153 @@
+import numpy as np
+from strategy.backtest import prepare_backtest, load_backtest_data, select_weights
+from strategy.stockdata import DataError, trading_calendar
+from strategy.pricestore import to_day
+
+TRADING_DAYS_PER_YEAR = 252
+
+
+class Universe:
+    def __init__(self):
+        self.columns = {}
+        self.tickers = []
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def index(self, tickers):
+        for ticker in tickers:
+            if ticker not in self.columns:
+                self.columns[ticker] = len(self.tickers)
+                self.tickers.append(ticker)
+        return np.array([self.columns[ticker] for ticker in tickers], dtype=np.intp)
+
+
+class ArrayPortfolio:
+    def __init__(self, universe, cash):
+        self.universe = universe
+        self.cash = float(cash)
+        self.shares = np.zeros(len(universe))
+
+    def fit(self):
+        if len(self.shares) < len(self.universe):
+            self.shares = np.concatenate([self.shares, np.zeros(len(self.universe) - len(self.shares))])
+
+    def held(self):
+        return np.flatnonzero(self.shares)
+
+    def holdings(self):
+        return {self.universe.tickers[column]: int(self.shares[column]) for column in self.held()}
+
+
+def column_prices(universe, columns, buy_columns, date, book):
+    prices = np.empty(len(columns))
+    for i, column in enumerate(columns):
+        ticker = universe.tickers[column]
+        price_date, open_price = book.open_as_of(ticker, date)
+        if price_date != date and column in buy_columns:
+            raise DataError("Cannot backtest further (unknown buy price for '" + ticker + "').")
+        if open_price is None:
+            raise DataError("Cannot backtest further (unknown sale price for '" + ticker + "').")
+        prices[i] = open_price
+    return prices
+
+
+def rebalance_arrays(portfolio, next_weight, date, book):
+    universe = portfolio.universe
+    held = portfolio.held()
+    buy_columns = universe.index(list(next_weight.keys()))
+    portfolio.fit()
+    columns = np.union1d(held, buy_columns)
+    prices = column_prices(universe, columns, set(buy_columns.tolist()), date, book)
+
+    values = portfolio.shares[columns] * prices
+    total = portfolio.cash + values.sum()
+    target = np.zeros(len(universe))
+    target[buy_columns] = list(next_weight.values())
+    delta = target[columns] - values / total
+    transactions = np.round(delta * total / prices)     # Half to even, like round() in backtest.buy_sell
+    portfolio.shares[columns] += transactions
+    portfolio.cash -= float(np.dot(transactions, prices))
+    print("BACKTEST: Portfolio value: $" + str(round(total, 2)) + " on " + date + ", " +
+          str(np.count_nonzero(transactions)) + " trades")
+    return float(total)
+
+
+def price_matrix(book, tickers, days):     # Date x ticker opens, each filled from the last earlier open
+    book.load(tickers)
+    matrix = np.full((len(days), len(tickers)), np.nan)
+    for column, ticker in enumerate(tickers):
+        if ticker not in book.series:
+            continue
+        series_days = np.frombuffer(book.series[ticker].days.tobytes(), dtype=np.int32)
+        opens = np.frombuffer(book.series[ticker].opens.tobytes(), dtype=np.float64)
+        index = np.searchsorted(series_days, days, side='right') - 1
+        matrix[:, column] = np.where(index >= 0, opens[np.maximum(index, 0)], np.nan)
+    return matrix
+
+
+def equity_curve(states, universe, book, end_date):
+    calendar = trading_calendar()
+    days = []
+    values = []
+    for i, (date, shares, cash) in enumerate(states):
+        stop_date = states[i + 1][0] if i + 1 < len(states) else None
+        segment = [to_day(day) for day in calendar.between(date, stop_date or end_date) if day != stop_date]
+        if not segment:
+            continue
+        columns = np.flatnonzero(shares)
+        matrix = price_matrix(book, [universe.tickers[column] for column in columns], np.array(segment))
+        days.extend(segment)
+        values.append(matrix @ shares[columns] + cash)
+    return np.array(days, dtype=np.int32), np.concatenate(values) if values else np.empty(0)
+
+
+def risk_metrics(days, values):
+    if len(values) < 2:
+        return {}
+    returns = values[1:] / values[:-1] - 1
+    years = (days[-1] - days[0]) / 365.25
+    volatility = returns.std(ddof=1)
+    drawdowns = values / np.maximum.accumulate(values) - 1
+    return {'cagr': round(float((values[-1] / values[0]) ** (1 / years) - 1) * 100, 2) if years > 0 else 0.0,
+            'volatility': round(float(volatility * np.sqrt(TRADING_DAYS_PER_YEAR)) * 100, 2),
+            'max_drawdown': round(float(-drawdowns.min()) * 100, 2),
+            'sharpe': round(float(returns.mean() / volatility * np.sqrt(TRADING_DAYS_PER_YEAR)), 2)
+            if volatility > 0 else 0.0}
+
+
+def backtest_vectorized(cik, min_date, max_date, num_stocks_list, initial_bank, daily=False):
+    min_date, schedule = prepare_backtest(cik, min_date, max_date)
+    forms, book = load_backtest_data(cik, schedule, max(num_stocks_list))
+    universe = Universe()
+    portfolios = {num_stocks: ArrayPortfolio(universe, initial_bank) for num_stocks in num_stocks_list}
+    running_balances = {num_stocks: 0 for num_stocks in num_stocks_list}
+    states = {num_stocks: [] for num_stocks in num_stocks_list}
+    failed = set()
+
+    for formID, date, next_date in schedule:
+        for num_stocks in num_stocks_list:
+            if num_stocks in failed:
+                continue
+            try:
+                weights = select_weights(forms[formID], date, next_date, num_stocks, book)
+                running_balances[num_stocks] = rebalance_arrays(portfolios[num_stocks], weights, date, book)
+            except DataError as e:
+                print("WARNING/BT: Backtest for " + cik + " with " + str(num_stocks) + " stocks stopped: " + str(e))
+                failed.add(num_stocks)
+                continue
+            if daily:
+                portfolio = portfolios[num_stocks]
+                states[num_stocks].append((date, portfolio.shares.copy(), portfolio.cash))
+
+    results = {}
+    for num_stocks in [num_stocks for num_stocks in num_stocks_list if num_stocks not in failed]:
+        results[str(num_stocks)] = {'num_stocks': str(len(portfolios[num_stocks].held())),
+                                    'min_date': min_date,
+                                    'return': round(((running_balances[num_stocks] / initial_bank) - 1) * 100, 2)}
+        if daily:
+            days, values = equity_curve(states[num_stocks], universe, book, max_date)
+            results[str(num_stocks)]['metrics'] = risk_metrics(days, values)
+            results[str(num_stocks)]['curve'] = {'days': days.tobytes(),   # Day ordinals and values, packed
+                                                 'values': values.astype(np.float32).tobytes()}
+    return results
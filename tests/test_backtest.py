@@ -35,49 +35,6 @@ def test_db_get_form_holdings():
     assert bt.db_get_form_holdings("000108514619000438", "0001040273") == holdings
 
 
-def test_find_valid_tickers():
-    holdings = {'ADBE': 203616, 'AXP': 276428, 'BAX': 1842960, 'CPB': 692790, 'CI': 109204, 'STZ': 281435,
-                'DHR': 320703, 'DOV': 43634, 'DWDP': 516360, 'FPAC': 158337, 'FPACU': 40360, 'IQV': 189357, 'SHY': 3336,
-                'KDMN': 19568, 'MRK': 212038, 'PYPL': 338462, 'SPGI': 135952, 'CRM': 160940, 'SHPG': 299247,
-                'BID': 264732, 'V': 197910, 'WP': 201011}
-    weights, failed = bt.find_valid_tickers(holdings, 50, [], '2019-02-11')
-    del holdings['FPACU']
-    del holdings['SHPG']
-    expected_weights = bt.value_to_weight(holdings)
-    assert weights == approx(expected_weights, abs=1e-15)
-    assert failed == ['SHPG', 'FPACU']
-
-
-def test_find_valid_tickers_15():
-    holdings = {'ADBE': 203616, 'AXP': 276428, 'BAX': 1842960, 'CPB': 692790, 'CI': 109204, 'STZ': 281435,
-                'DHR': 320703, 'DOV': 43634, 'DWDP': 516360, 'FPAC': 158337, 'FPACU': 40360, 'IQV': 189357, 'SHY': 3336,
-                'KDMN': 19568, 'MRK': 212038, 'PYPL': 338462, 'SPGI': 135952, 'CRM': 160940, 'SHPG': 299247,
-                'BID': 264732, 'V': 197910, 'WP': 201011}
-    trimmed = {'ADBE': 203616, 'AXP': 276428, 'BAX': 1842960, 'CPB': 692790, 'STZ': 281435,
-               'DHR': 320703, 'DWDP': 516360, 'IQV': 189357,
-               'MRK': 212038, 'PYPL': 338462, 'CRM': 160940,
-               'BID': 264732, 'V': 197910, 'WP': 201011}
-    weights, failed = bt.find_valid_tickers(holdings, 15, [], '2019-02-11')
-    expected_weights = bt.value_to_weight(trimmed)
-    assert weights == approx(expected_weights, abs=1e-15)
-    assert failed == ['SHPG']
-
-
-def test_find_valid_tickers_failed():
-    holdings = {'ADBE': 203616, 'AXP': 276428, 'BAX': 1842960, 'CPB': 692790, 'CI': 109204, 'STZ': 281435,
-                'DHR': 320703, 'DOV': 43634, 'DWDP': 516360, 'FPAC': 158337, 'FPACU': 40360, 'IQV': 189357, 'SHY': 3336,
-                'KDMN': 19568, 'MRK': 212038, 'PYPL': 338462, 'SPGI': 135952, 'CRM': 160940, 'SHPG': 299247,
-                'BID': 264732, 'V': 197910, 'WP': 201011}
-    trimmed = {'ADBE': 203616, 'AXP': 276428, 'BAX': 1842960, 'CPB': 692790, 'STZ': 281435,
-               'DHR': 320703, 'DWDP': 516360, 'FPAC': 158337, 'IQV': 189357,
-               'MRK': 212038, 'PYPL': 338462, 'CRM': 160940,
-               'BID': 264732, 'V': 197910, 'WP': 201011}
-    weights, failed = bt.find_valid_tickers(holdings, 16, ['SHPG'], '2019-02-11')
-    expected_weights = bt.value_to_weight(trimmed)
-    assert weights == approx(expected_weights, abs=1e-15)
-    assert failed == ['SHPG']
-
-
 def test_ensure_valid_data():
     trimmed = {'ADBE': 203616, 'AXP': 276428, 'BAX': 1842960, 'CPB': 692790, 'STZ': 281435,
                'DHR': 320703, 'DWDP': 516360, 'FPAC': 158337, 'IQV': 189357,
@@ -173,3 +130,89 @@ def test_backtest_five():
     num, backtest = bt.backtest("0001040273", '2018-08-01', '2019-02-08', 5, 100000)
     assert num == "5"
     assert backtest == expected_backtest
+
+
+def test_backtest_many_matches_single():
+    results = bt.backtest_many("0001040273", '2018-08-01', '2019-02-08', [5, 9], 100000)
+    assert results['5'] == {"num_stocks": "5", "min_date": '2018-08-01', 'return': -4.92}
+    assert results['9'] == {"num_stocks": "9", "min_date": '2018-08-01', 'return': -7.95}
+
+
+def test_checkpoint_versions_prefix():
+    schedule = [('a', '2018-02-15', None), ('b', '2018-05-16', None)]
+    versions = bt.checkpoint_versions(schedule, '2014-01-01', 100000)
+    longer = bt.checkpoint_versions(schedule + [('c', '2018-08-15', None)], '2014-01-01', 100000)
+    backfilled = bt.checkpoint_versions([('z', '2017-11-14', None)] + schedule, '2014-01-01', 100000)
+    assert longer[:2] == versions
+    assert not set(backfilled) & set(versions)
+
+
+def test_backtest_many_resume(monkeypatch):
+    cik = "0001040273"
+    rebalanced = []
+    rebalance = bt.rebalance
+
+    def counting_rebalance(portfolio, next_weight, date, book=None):
+        rebalanced.append(date)
+        return rebalance(portfolio, next_weight, date, book)
+
+    monkeypatch.setattr(bt, 'rebalance', counting_rebalance)
+    _, schedule = bt.prepare_backtest(cik, '2018-08-01', '2019-02-08')
+    versions = bt.checkpoint_versions(schedule, '2018-08-01', 100000)
+    bumped = None
+    bt.db.backtest_checkpoints.delete_many({'cik': cik})
+    try:
+        expected = bt.backtest_many(cik, '2018-08-01', '2019-02-08', [5, 9], 100000)
+        assert bt.db.backtest_checkpoints.count_documents({'cik': cik}) == 0
+
+        del rebalanced[:]
+        assert bt.backtest_many(cik, '2018-08-01', '2019-02-08', [5, 9], 100000, resume=True) == expected
+        assert len(rebalanced) == 2 * len(schedule)
+        for num_stocks in [5, 9]:
+            stored = bt.db.backtest_checkpoints.find({'cik': cik, 'num_stocks': num_stocks})
+            assert sorted(checkpoint['data_version'] for checkpoint in stored) == sorted(versions)
+
+        # Only the forms after the newest remaining checkpoint are run again
+        bt.db.backtest_checkpoints.delete_many({'cik': cik, 'data_version': versions[-1]})
+        del rebalanced[:]
+        assert bt.backtest_many(cik, '2018-08-01', '2019-02-08', [5, 9], 100000, resume=True) == expected
+        assert rebalanced == [schedule[-1][1]] * 2
+
+        del rebalanced[:]
+        assert bt.backtest_many(cik, '2018-08-01', '2019-02-08', [5, 9], 100000, resume=True) == expected
+        assert rebalanced == []
+
+        # Adjusted prices for a ticker held from the first form invalidate every checkpoint that used them
+        first = [{ticker for ticker, _ in checkpoint['prices']} for checkpoint in
+                 bt.db.backtest_checkpoints.find({'cik': cik, 'data_version': versions[0]})]
+        bumped = sorted(first[0] & first[1])[0]
+        bt.db.prices.update_one({'name': bumped}, {'$inc': {'revision': 1}})
+        del rebalanced[:]
+        assert bt.backtest_many(cik, '2018-08-01', '2019-02-08', [5, 9], 100000, resume=True) == expected
+        assert len(rebalanced) == 2 * len(schedule)
+    finally:
+        if bumped is not None:
+            bt.db.prices.update_one({'name': bumped}, {'$inc': {'revision': -1}})
+        bt.db.backtest_checkpoints.delete_many({'cik': cik})
+
+
+class FailingBook:
+    def __init__(self, failed):
+        self.failed = failed
+        self.requested = []
+
+    def get_data(self, tickers, date):
+        self.requested.append(list(tickers))
+        return [ticker for ticker in tickers if ticker in self.failed]
+
+
+def test_form_holdings_top_skips_failed():
+    form = bt.FormHoldings({'A': 10, 'B': 50, 'C': 30, 'D': 40, 'E': 20})
+    book = FailingBook({'D', 'C'})
+    assert form.top(3, '2019-02-11', book) == {'B': 50, 'E': 20, 'A': 10}
+    assert book.requested == [['B', 'D', 'C'], ['E', 'A']]
+
+
+def test_form_holdings_top_too_few():
+    form = bt.FormHoldings({'A': 10, 'B': 50})
+    assert form.top(5, '2019-02-11', FailingBook({'A'})) == {'B': 50}
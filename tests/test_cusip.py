@@ -1,3 +1,4 @@
+import io
 import strategy.cusip as cusip
 
 
@@ -18,3 +19,11 @@ def test_create_cusip_map():
     full_map = {'D1668R123': 'DDAIF', 'D18190822': 'ABC', 'G01767110': 'DEF',
                 'D18190898': 'ABC', 'G01767105': 'ALKS'}
     assert cusip_map == full_map
+
+
+def test_iter_fail_filing_dates():
+    rows = ["SETTLEMENT DATE|CUSIP|SYMBOL|QUANTITY (FAILS)|DESCRIPTION|PRICE\n",
+            "20190102|037833100|AAPL|100|APPLE INC|157.92\n",
+            "20190103|D1668R123|DDAIFXXXX|50|DAIMLER AG|52.10\n"]
+    assert list(cusip.iter_fail_filing(io.StringIO(''.join(rows)))) == [('037833100', 'AAPL', '2019-01-02'),
+                                                                       ('D1668R123', 'DDAIF', '2019-01-03')]
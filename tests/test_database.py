@@ -0,0 +1,34 @@
+import strategy.database as database
+
+
+class FakeClient:
+    created = 0
+
+    def __init__(self, pool_size):
+        FakeClient.created += 1
+        self.pool_size = pool_size
+
+    def get_database(self):
+        return {'forms': 'forms collection'}
+
+
+def test_lazy_backend():
+    database.use_backend(FakeClient)
+    try:
+        assert FakeClient.created == 0
+        assert database.db['forms'] == 'forms collection'
+        assert database.get_client() is database.get_client()
+        assert FakeClient.created == 1
+        assert database.get_client().pool_size == database.POOL_SIZE
+    finally:
+        database.use_backend(None)
+
+
+def test_new_client_after_fork():
+    database.use_backend(FakeClient)
+    try:
+        client = database.get_client()
+        database.state['pid'] = -1  # As seen from a forked child
+        assert database.get_client() is not client
+    finally:
+        database.use_backend(None)
@@ -23,6 +23,23 @@ def test_cusip_to_ticker_bad():
     assert ed.cusip_to_ticker("AAAAAAAA0") == "AAAAAAAA0"
 
 
+def test_cusip_resolver_batches_bad():
+    resolver = ed.CusipResolver()
+    assert resolver.lookup("037833100") == "AAPL"
+    assert resolver.lookup("AAAAAAAA0") == "AAAAAAAA0"
+    assert resolver.bad_cusips == {"AAAAAAAA0"}
+    resolver.flush_bad_cusips()
+    assert resolver.bad_cusips == set()
+
+
+def test_cusip_resolver_refresh_same_version():
+    resolver = ed.CusipResolver()
+    resolver.refresh()
+    cusip_map = resolver.cusip_map
+    resolver.refresh()
+    assert resolver.cusip_map is cusip_map
+
+
 def test_aggregate_holdings():
     holdings = {ed.SecurityType.SHARE: {"AOI": {
         "ticker": "AOI",
@@ -52,29 +69,35 @@ def test_aggregate_holdings():
 
 
 def test_get_holdings_plain():
-    with open('./data/form13_1.xml', "r") as xml:
-        test = ed.get_holdings(BeautifulSoup(xml, "xml"))
+    with open('./data/form13_1.xml', "rb") as xml:
+        test = ed.get_holdings(xml)
     with open('./data/holdings1.json', "r") as file:
         expected_holdings = json.load(file)
     assert test == expected_holdings['holdings']
 
 
 def test_get_holdings_call_option():
-    with open('./data/form13_2.xml', "r") as xml:
-        test = ed.get_holdings(BeautifulSoup(xml, "xml"))
+    with open('./data/form13_2.xml', "rb") as xml:
+        test = ed.get_holdings(xml)
     with open('./data/holdings2.json', "r") as file:
         expected_holdings = json.load(file)
     assert test == expected_holdings['holdings']
 
 
 def test_get_holdings_put_option():
-    with open('./data/form13_3.xml', "r") as xml:
-        test = ed.get_holdings(BeautifulSoup(xml, "xml"))
+    with open('./data/form13_3.xml', "rb") as xml:
+        test = ed.get_holdings(xml)
     with open('./data/holdings3.json', "r") as file:
         expected_holdings = json.load(file)
     assert test == expected_holdings['holdings']
 
 
+def test_iter_info_table_option_type():
+    with open('./data/form13_3.xml', "rb") as xml:
+        security_types = {row[1] for row in ed.iter_info_table(xml)}
+    assert ed.SecurityType.PUT in security_types
+
+
 def test_get_link_and_date():
     with open('./data/filing_page.html') as page:
         soup = BeautifulSoup(page, "html.parser")
@@ -99,3 +122,24 @@ def test_get_link_and_date_none():
     assert date is None
 
 
+def test_changed_gains():
+    forms = [{'_id': 1, 'date': '2019-02-14', 'total_val': 100, 'gain': False},
+             {'_id': 2, 'date': '2019-05-15', 'total_val': 150, 'gain': 50},
+             {'_id': 3, 'date': '2019-08-14', 'total_val': 120, 'gain': False},
+             {'_id': 4, 'date': '2019-11-14', 'total_val': 200, 'gain': 10}]
+    assert ed.changed_gains(forms) == [(3, -30), (4, 80)]
+
+
+def test_changed_gains_zero_replaces_false():
+    forms = [{'_id': 1, 'date': '2019-02-14', 'total_val': 100, 'gain': False},
+             {'_id': 2, 'date': '2019-05-15', 'total_val': 100, 'gain': False}]
+    assert ed.changed_gains(forms) == [(2, 0)]
+
+
+def test_form13f_to_document():
+    holdings = [{'ticker': 'AAPL', 'name': 'Apple Inc', 'security_type': 'Share', 'value': 100, 'units': 5},
+                {'ticker': 'AAPL', 'name': 'Apple Inc', 'security_type': 'Put', 'value': 20, 'units': 1}]
+    form = ed.Form13F('0001040273', '000108514619000438', 'Company', '2019-02-14', 'link', holdings)
+    assert form.to_document() == {'cik': '0001040273', 'name': 'Company', 'sec_id': '000108514619000438',
+                                  'date': '2019-02-14', 'link': 'link', 'holdings': holdings, 'share_val': 100,
+                                  'total_val': 120, 'num_holdings': 2, 'gain': False}
@@ -0,0 +1,29 @@
+import time
+import strategy.fetch as fetch
+
+
+def test_rate_limiter_spacing():
+    limiter = fetch.RateLimiter(50)
+    start = time.monotonic()
+    for i in range(6):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_rate_limiter_burst():
+    limiter = fetch.RateLimiter(1, 3)
+    start = time.monotonic()
+    for i in range(3):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.5
+
+
+def test_cache_key_ignores_token():
+    url = 'https://api.tiingo.com/tiingo/daily/AAPL/prices'
+    assert fetch.cache_key(url, {'token': 'a', 'startDate': '2014-01-01'}) \
+        == fetch.cache_key(url, {'startDate': '2014-01-01', 'token': 'b'})
+
+
+def test_cache_ttl_archive_permanent():
+    assert fetch.cache_ttl('https://www.sec.gov/Archives/edgar/data/1327388/000139834414005663/table.xml') is None
+    assert fetch.cache_ttl('https://www.sec.gov/cgi-bin/browse-edgar?action=getcompany&CIK=1') == fetch.LISTING_TTL
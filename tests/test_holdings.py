@@ -0,0 +1,12 @@
+import strategy.holdings as hd
+
+
+def test_holding_documents():
+    form = {'cik': '0001040273', 'sec_id': '000108514619000438', 'date': '2019-02-14',
+            'holdings': [{'ticker': 'AAPL', 'name': 'Apple Inc', 'security_type': 'Share', 'value': 100, 'units': 5},
+                         {'ticker': 'AAPL', 'name': 'Apple Inc', 'security_type': 'Put', 'value': 20, 'units': 1}]}
+    assert hd.holding_documents(form) == [
+        {'cik': '0001040273', 'sec_id': '000108514619000438', 'date': '2019-02-14', 'ticker': 'AAPL',
+         'name': 'Apple Inc', 'security_type': 'Share', 'value': 100, 'units': 5},
+        {'cik': '0001040273', 'sec_id': '000108514619000438', 'date': '2019-02-14', 'ticker': 'AAPL',
+         'name': 'Apple Inc', 'security_type': 'Put', 'value': 20, 'units': 1}]
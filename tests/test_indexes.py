@@ -0,0 +1,12 @@
+import strategy.indexes as ix
+
+
+def test_plan_stages_collscan():
+    explained = {'queryPlanner': {'winningPlan': {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}}}
+    assert [stage for plan in ix.winning_plans(explained) for stage in ix.plan_stages(plan)] == ['SORT', 'COLLSCAN']
+
+
+def test_plan_stages_aggregation():
+    explained = {'stages': [{'$cursor': {'queryPlanner': {'winningPlan': {
+                    'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}}}}, {'$group': {}}]}
+    assert [stage for plan in ix.winning_plans(explained) for stage in ix.plan_stages(plan)] == ['FETCH', 'IXSCAN']
@@ -0,0 +1,58 @@
+import strategy.pricestore as ps
+from pytest import approx
+
+HISTORY = {'2019-01-02': 10.0, '2019-01-03': 11.0, '2019-01-07': 12.5}
+
+
+def test_open_on():
+    series = ps.PriceSeries.from_history('TEST', HISTORY)
+    assert series.open_on('2019-01-03') == 11.0
+    assert series.open_on('2019-01-04') is None
+
+
+def test_as_of():
+    series = ps.PriceSeries.from_history('TEST', HISTORY)
+    assert series.as_of('2019-01-06') == ('2019-01-03', 11.0)
+    assert series.as_of('2019-01-07') == ('2019-01-07', 12.5)
+    assert series.as_of('2019-01-01') == (None, None)
+
+
+def test_extend_append_and_merge():
+    series = ps.PriceSeries.from_history('TEST', HISTORY)
+    series.extend({'2019-01-08': 13.0})
+    series.extend({'2019-01-04': 11.5, '2019-01-08': 13.0})
+    assert list(series.opens) == [10.0, 11.0, 11.5, 12.5, 13.0]
+    assert series.last_date() == '2019-01-08'
+
+
+def test_document_round_trip():
+    series = ps.PriceSeries.from_history('TEST', HISTORY)
+    document = dict(series.arrays(), name='TEST', revision=3)
+    loaded = ps.PriceSeries.from_document(document)
+    assert list(loaded.days) == list(series.days)
+    assert list(loaded.opens) == list(series.opens)
+    assert loaded.revision == 3
+
+
+
+def test_document_tail_rows():
+    series = ps.PriceSeries.from_history('TEST', HISTORY)
+    day = ps.to_day('2019-01-08')
+    document = dict(series.arrays(), name='TEST', tail_days=[day, day], tail_opens=[13.0, 13.5])
+    loaded = ps.PriceSeries.from_document(document)
+    assert list(loaded.opens) == [10.0, 11.0, 12.5, 13.5]
+    assert loaded.tail == 2
+
+
+def test_load_series_shpg():
+    assert ps.load_series('SHPG').open_on('2019-02-07') == approx(179.2)
+
+
+def test_series_cache_evicts_least_recent():
+    cache = ps.SeriesCache(5)
+    cache.put('A', ps.PriceSeries.from_history('A', HISTORY))
+    cache.put('B', ps.PriceSeries.from_history('B', {'2019-01-02': 1.0}))
+    cache.get_many(['A'])
+    cache.put('C', ps.PriceSeries.from_history('C', {'2019-01-02': 1.0, '2019-01-03': 2.0}))
+    assert list(cache.series) == ['A', 'C']
+    assert cache.points == 5
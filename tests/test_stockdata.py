@@ -40,6 +40,16 @@ def test_data_request_other_api_error():
         pass    # expected
 
 
+def test_has_corporate_action():
+    assert not sd.has_corporate_action([{'date': '2019-01-02', 'adjOpen': 1.0, 'divCash': 0.0, 'splitFactor': 1.0}])
+    assert sd.has_corporate_action([{'date': '2019-01-02', 'adjOpen': 1.0, 'divCash': 0.5, 'splitFactor': 1.0}])
+    assert sd.has_corporate_action([{'date': '2019-01-02', 'adjOpen': 1.0, 'divCash': 0.0, 'splitFactor': 2.0}])
+
+
+def test_stored_last_dates():
+    assert sd.stored_last_dates(['SHPG'])['SHPG'] >= '2019-01-07'
+
+
 def test_recent_open_exact():
     assert sd.recent_open('SHPG', '2019-02-07') == approx(179.2)
 
@@ -52,6 +62,12 @@ def test_recent_open_future():
     assert sd.recent_open('SHPG', '2218-01-15') == approx(179.2)
 
 
+def test_open_as_of_recent():
+    date, price = sd.open_as_of('SHPG', '2019-01-06')
+    assert date == '2019-01-04'
+    assert price == approx(176.6)
+
+
 def test_recent_open_fail():
     assert sd.recent_open('FPACU', '2018-01-15') is None
 
@@ -72,6 +88,13 @@ def test_update_stock_db_2fail():
     assert sd.update_stock_db(['SHPG', 'FPACU', 'AAPL'], '2019-01-09') == ['SHPG', 'FPACU']
 
 
+def test_price_book_remembers_failed():
+    book = sd.PriceBook(['SHPG', 'AAPL'])
+    assert book.get_data(['SHPG', 'FPACU', 'AAPL'], '2019-01-08') == ['FPACU']
+    assert book.failed['2019-01-08'] == {'FPACU'}
+    assert book.open_as_of('SHPG', '2019-01-06')[0] == '2019-01-04'
+
+
 def test_next_trading_day_weekday():
     assert sd.next_trading_day('2019-01-08') == '2019-01-09'
 
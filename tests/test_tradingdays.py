@@ -0,0 +1,33 @@
+import strategy.pricestore as ps
+from strategy.tradingdays import TradingCalendar
+
+AAPL = ps.PriceSeries.from_history('AAPL', {'2018-12-28': 1.0, '2019-01-02': 1.0, '2019-01-04': 1.0})
+WMT = ps.PriceSeries.from_history('WMT', {'2018-12-31': 1.0, '2019-01-03': 1.0})
+
+
+def test_calendar_union():
+    calendar = TradingCalendar.from_series([AAPL, WMT])
+    assert calendar.between('2018-12-01', '2019-12-01') == ['2018-12-28', '2018-12-31', '2019-01-02',
+                                                            '2019-01-03', '2019-01-04']
+
+
+def test_calendar_next_previous():
+    calendar = TradingCalendar.from_series([AAPL, WMT])
+    assert calendar.next_day('2018-12-31') == '2019-01-02'
+    assert calendar.next_day('2018-12-29') == '2018-12-31'
+    assert calendar.next_day('2019-01-04') is None
+    assert calendar.previous_day('2019-01-01') == '2018-12-31'
+    assert calendar.previous_day('2018-12-28') is None
+
+
+def test_calendar_is_trading_day():
+    calendar = TradingCalendar.from_series([AAPL, WMT])
+    assert calendar.is_trading_day('2019-01-03')
+    assert not calendar.is_trading_day('2019-01-01')
+
+
+def test_calendar_save_load(tmp_path):
+    path = str(tmp_path / 'days.json')
+    TradingCalendar.from_series([AAPL, WMT]).save(path)
+    assert TradingCalendar.load(path).last_date() == '2019-01-04'
+    assert TradingCalendar.load(str(tmp_path / 'missing.json')) is None
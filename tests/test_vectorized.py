@@ -0,0 +1,66 @@
+import numpy as np
+import strategy.backtest as bt
+import strategy.pricestore as ps
+import strategy.vectorized as vz
+from pytest import approx
+
+
+class FixedPrices:
+    def __init__(self, prices, date):
+        self.prices = prices
+        self.date = date
+
+    def open_as_of(self, ticker, date):
+        if ticker not in self.prices:
+            return None, None
+        return self.date, self.prices[ticker]
+
+
+def test_rebalance_arrays_matches_buy_sell():
+    prices = {"AAPL": 171.05, "AIG": 42.67, "BA": 408.10, "WMT": 95.65, "NFLX": 350.0}
+    universe = vz.Universe()
+    portfolio = vz.ArrayPortfolio(universe, 0.0)
+    columns = universe.index(["AAPL", "WMT", "BA", "AIG", "NFLX"])
+    portfolio.fit()
+    portfolio.shares[columns] = [110, 20, 51, 230, 48]
+    next_weight = {"AAPL": 0.5, "WMT": 0.3, "BA": 0.1, "NFLX": 0.10}
+    total = vz.rebalance_arrays(portfolio, next_weight, '2019-02-11', FixedPrices(prices, '2019-02-11'))
+    assert total == approx(68155.70)
+    assert portfolio.holdings() == {"AAPL": 199, "WMT": 214, "BA": 17, "NFLX": 19}
+    assert portfolio.cash == approx(59.95)
+
+
+def test_rebalance_arrays_missing_buy():
+    universe = vz.Universe()
+    portfolio = vz.ArrayPortfolio(universe, 100.0)
+    try:
+        vz.rebalance_arrays(portfolio, {"AAAAAAAA0": 1.0}, '2019-02-11', FixedPrices({}, '2019-02-11'))
+        assert False
+    except vz.DataError:
+        pass    # expected
+
+
+def test_backtest_vectorized_matches():
+    expected = bt.backtest_many("0001040273", '2018-08-01', '2019-02-08', [5, 9], 100000)
+    assert vz.backtest_vectorized("0001040273", '2018-08-01', '2019-02-08', [5, 9], 100000) == expected
+
+
+def test_risk_metrics():
+    days = np.array([737000, 737487, 737974, 738461])   # Exactly four years apart end to end
+    values = np.array([100.0, 110.0, 99.0, 108.9])      # Returns of +10%, -10%, +10%
+    metrics = vz.risk_metrics(days, values)
+    assert metrics == {'cagr': 2.15, 'volatility': 183.3, 'max_drawdown': 10.0, 'sharpe': 4.58}
+    assert vz.risk_metrics(days[:1], values[:1]) == {}
+
+
+def test_price_matrix_fills_forward():
+    class Book:
+        series = {'AAPL': ps.PriceSeries.from_history('AAPL', {'2019-01-02': 1.0, '2019-01-04': 2.0})}
+
+        def load(self, tickers):
+            pass
+    days = np.array([ps.to_day(date) for date in ['2019-01-01', '2019-01-03', '2019-01-07']])
+    matrix = vz.price_matrix(Book(), ['AAPL', 'NONE'], days)
+    assert np.isnan(matrix[0, 0])
+    assert list(matrix[1:, 0]) == [1.0, 2.0]
+    assert np.isnan(matrix[:, 1]).all()
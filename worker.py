@@ -1,31 +1,82 @@
-from strategy.edgar import update_filings, update_gains
-from strategy.backtest import backtest
+from strategy.edgar import update_all_filings
+from strategy.backtest import backtest_job, backtest_many
+from strategy.vectorized import backtest_vectorized
 from strategy.stockdata import update_trading_days
-from pymongo import MongoClient
-from os import environ
+from strategy.dashboard import rebuild_dashboard
+from strategy.holdings import backfill_holdings
+from strategy.database import db
+from strategy.indexes import ensure_indexes, audit_queries
+from strategy.cusip import migrate_legacy_map
+from os import environ, cpu_count
 from datetime import datetime
+from threading import Thread
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+import multiprocessing
 import argparse
+import time
 
-client = MongoClient(environ['MONGODB_URI'])
-db = client.get_database()
-update_list = db.cik.find_one()['cik']
 num_stock_list = [5, 15, 50]
-update_trading_days()
+BACKTEST_PROCESSES = int(environ.get('BACKTEST_PROCESSES', cpu_count() or 1))
 
 
-parser = argparse.ArgumentParser(description="pull forms and/or backtest")
-parser.add_argument('-f', action="store_true")
-parser.add_argument('-b', action="store_true")
-args = parser.parse_args()
+def run_backtests(update_list, engine):
+    today = datetime.today().strftime("%Y-%m-%d")
+    start = time.perf_counter()
+    # Spawned children open their own Mongo connections instead of inheriting ours
+    with ProcessPoolExecutor(BACKTEST_PROCESSES, mp_context=multiprocessing.get_context('spawn')) as pool:
+        jobs = {pool.submit(backtest_job, engine, cik, '2014-01-01', today, num_stock_list, 1000000): cik
+                for cik in update_list}
+        for done, job in enumerate(as_completed(jobs), 1):
+            try:
+                cik, results, seconds = job.result()
+            except Exception as e:  # One company's failure must not lose the others' results
+                print("WARNING/WK: Backtest for " + jobs[job] + " failed: " + repr(e))
+                continue
+            print("WORKER: Backtested " + cik + " (" + str(done) + "/" + str(len(jobs)) + ") in " +
+                  str(round(seconds, 1)) + "s")
+            update = {num_stocks: result for num_stocks, result in results.items() if result['return'] != -100.0}
+            if update:  # Written as each company finishes, so an interrupted run keeps what it has
+                db.backtest.update_one({'cik': cik}, {'$set': update}, upsert=True)
+    print("WORKER: Backtested " + str(len(update_list)) + " companies in " +
+          str(round(time.perf_counter() - start, 1)) + "s")
 
-if args.f:
-    for cik in update_list:
-        if update_filings(cik, 40):
-            update_gains(cik)
 
-if args.b:
-    for cik in update_list:
-        for num in num_stock_list:
-            num_stocks, result = backtest(cik, '2014-01-01', datetime.today().strftime("%Y-%m-%d"), num, 1000000)
-            if result['return'] != -100.0:
-                db.backtest.update_one({'cik': cik}, {'$set': {num_stocks: result}}, upsert=True)
+def main():
+    parser = argparse.ArgumentParser(description="pull forms and/or backtest")
+    parser.add_argument('-f', action="store_true")
+    parser.add_argument('-b', action="store_true")
+    parser.add_argument('-d', action="store_true", help="also store daily equity curves and risk metrics")
+    parser.add_argument('-n', action="store_true", help="backfill the normalized holdings collection")
+    parser.add_argument('-i', action="store_true", help="create any missing indexes before other work")
+    parser.add_argument('-e', action="store_true", help="explain the hot queries and flag collection scans")
+    args = parser.parse_args()
+
+    update_list = db.cik.find_one()['cik']
+    calendar_refresh = Thread(target=update_trading_days)   # Only backtests need it, so filings start right away
+    calendar_refresh.start()
+
+    if args.i:
+        ensure_indexes()
+        migrate_legacy_map()
+
+    if args.e:
+        audit_queries()
+
+    if args.n:
+        backfill_holdings()
+
+    if args.f:
+        migrate_legacy_map()    # Filings resolve tickers from the per-CUSIP collection
+        update_all_filings(update_list, 40)     # Gains are refreshed as each company is updated
+        rebuild_dashboard()
+
+    if args.b:
+        calendar_refresh.join()
+        engine = partial(backtest_vectorized, daily=True) if args.d else partial(backtest_many, resume=True)
+        run_backtests(update_list, engine)
+        rebuild_dashboard()
+
+
+if __name__ == '__main__':
+    main()